@@ -0,0 +1,83 @@
+"""
+Benchmark the compressions of the text, tokens and counts levels.
+
+Run from the root of the repository, after process_data.py (without
+--compression), e.g.
+
+    python -m benchmarks.bench_compression -p '1*'
+
+Every file of each level matching the pattern is written and read back
+with each compression, as process_book and the readers do. The script
+reports, for each level and compression, the bytes on disk and those
+saved, and the CPU time spent writing and reading, and fails if any
+file read back differs. zstd is left out if zstandard is not installed.
+"""
+import argparse
+import glob
+import io
+import os
+import tempfile
+import time
+from os.path import join
+
+from src.compression import SUFFIXES, open_compressed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Compare the disk space and CPU time of the compressions.")
+    parser.add_argument(
+        "-d", "--data",
+        help="Path to the data-folder, with the text, tokens and counts folders",
+        default='data/',
+        type=str)
+    parser.add_argument(
+        "-p", "--pattern",
+        help="Patttern to specify a subset of books",
+        default='*',
+        type=str)
+    args = parser.parse_args()
+
+    compressions = [None, "gzip"]
+    try:
+        import zstandard
+        compressions.append("zstd")
+    except ImportError:
+        print("zstandard is not installed, skipping zstd")
+
+    tmp_dir = tempfile.mkdtemp()
+    print("%-7s %-5s %10s %10s %7s %10s %10s" % (
+        "level", "comp", "MB", "MB saved", "ratio", "write s", "read s"))
+    for level in ("text", "tokens", "counts"):
+        filenames = glob.glob(join(args.data, level, 'PG%s_%s.txt' % (args.pattern, level)))
+        texts = []
+        for filename in filenames:
+            with io.open(filename, encoding="UTF-8") as f:
+                texts.append(f.read())
+        plain = None
+        for compression in compressions:
+            path = join(tmp_dir, level + ".txt" + SUFFIXES[compression])
+            nbytes = 0
+            t_write = 0.
+            t_read = 0.
+            for text in texts:
+                t0 = time.process_time()
+                with open_compressed(path, "w", compression) as f:
+                    f.write(text)
+                t1 = time.process_time()
+                with open_compressed(path) as f:
+                    text_read = f.read()
+                t2 = time.process_time()
+                if text_read != text:
+                    raise AssertionError("Outputs differ for %s with %s" % (level, compression))
+                nbytes += os.path.getsize(path)
+                t_write += t1 - t0
+                t_read += t2 - t1
+            os.remove(path)
+            if plain is None:
+                plain = nbytes
+            print("%-7s %-5s %10.1f %10.1f %7.2f %10.2f %10.2f" % (
+                level, compression or "none", nbytes / 2**20,
+                (plain - nbytes) / 2**20, plain / max(nbytes, 1), t_write, t_read))
+    os.rmdir(tmp_dir)
@@ -0,0 +1,105 @@
+"""
+Benchmark strip_headers against the original startswith-based version.
+
+Run from the root of the repository, e.g.
+
+    python -m benchmarks.bench_strip_headers -r data/raw/ -p '1*'
+
+Every raw file matching the pattern is cleaned with both versions. The
+script reports the time spent by each and fails if any output differs.
+"""
+import argparse
+import glob
+import io
+import os
+import time
+from os.path import join
+
+from src.cleanup import strip_headers
+from src.cleanup import TEXT_START_MARKERS, TEXT_END_MARKERS
+from src.cleanup import LEGALESE_START_MARKERS, LEGALESE_END_MARKERS
+
+
+def strip_headers_startswith(text):
+    """strip_headers as it was before the markers were compiled."""
+    lines = text.splitlines()
+    sep = str(os.linesep)
+
+    out = []
+    i = 0
+    footer_found = False
+    ignore_section = False
+
+    for line in lines:
+        reset = False
+
+        if i <= 600:
+            if any(line.startswith(token) for token in TEXT_START_MARKERS):
+                reset = True
+            if reset:
+                out = []
+                continue
+
+        if i >= 100:
+            if any(line.startswith(token) for token in TEXT_END_MARKERS):
+                footer_found = True
+            if footer_found:
+                break
+
+        if any(line.startswith(token) for token in LEGALESE_START_MARKERS):
+            ignore_section = True
+            continue
+        elif any(line.startswith(token) for token in LEGALESE_END_MARKERS):
+            ignore_section = False
+            continue
+
+        if not ignore_section:
+            out.append(line.rstrip(sep))
+            i += 1
+
+    return sep.join(out)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Compare the speed of strip_headers with the startswith version.")
+    parser.add_argument(
+        "-r", "--raw",
+        help="Path to the raw-folder",
+        default='data/raw/',
+        type=str)
+    parser.add_argument(
+        "-p", "--pattern",
+        help="Patttern to specify a subset of books",
+        default='*',
+        type=str)
+    args = parser.parse_args()
+
+    times = {"startswith": 0., "compiled": 0.}
+    nbooks = 0
+    nbytes = 0
+    for filename in glob.glob(join(args.raw, 'PG%s_raw.txt' % (args.pattern))):
+        try:
+            with io.open(filename, encoding="UTF-8") as f:
+                text = f.read()
+        except UnicodeDecodeError:
+            continue
+
+        t0 = time.perf_counter()
+        expected = strip_headers_startswith(text)
+        t1 = time.perf_counter()
+        clean = strip_headers(text)
+        t2 = time.perf_counter()
+
+        if clean != expected:
+            raise AssertionError("Outputs differ for '%s'" % filename)
+        times["startswith"] += t1 - t0
+        times["compiled"] += t2 - t1
+        nbooks += 1
+        nbytes += len(text)
+
+    print("%d books, %.1f MB of text, identical outputs" % (nbooks, nbytes / 2**20))
+    for name, t in times.items():
+        print("%-12s %8.2f s  %8.1f MB/s" % (name, t, nbytes / 2**20 / max(t, 1e-9)))
+    print("speedup      %8.1fx" % (times["startswith"] / max(times["compiled"], 1e-9)))
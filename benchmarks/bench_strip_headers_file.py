@@ -0,0 +1,79 @@
+"""
+Benchmark the ways of writing a text file from a raw file.
+
+Run from the root of the repository, e.g.
+
+    python -m benchmarks.bench_strip_headers_file -r data/raw/ -p '1*'
+
+Every raw file matching the pattern is cleaned with strip_headers (reading
+the whole file into memory), strip_headers_file (line by line) and
+strip_headers_mmap (memory-mapped, copying the body in blocks). The script
+reports the time spent by each and fails if any output differs.
+"""
+import argparse
+import glob
+import io
+import os
+import tempfile
+import time
+from os.path import join
+
+from src.cleanup import strip_headers, strip_headers_file, strip_headers_mmap
+
+
+def strip_headers_memory(path_in, path_out):
+    """Write the text file as process_book does by default."""
+    with io.open(path_in, encoding="UTF-8") as f:
+        text = f.read()
+    with io.open(path_out, "w", encoding="UTF-8") as f:
+        f.write(strip_headers(text))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Compare the speed of the ways of writing text files.")
+    parser.add_argument(
+        "-r", "--raw",
+        help="Path to the raw-folder",
+        default='data/raw/',
+        type=str)
+    parser.add_argument(
+        "-p", "--pattern",
+        help="Patttern to specify a subset of books",
+        default='*',
+        type=str)
+    args = parser.parse_args()
+
+    functions = {
+        "memory": strip_headers_memory,
+        "stream": strip_headers_file,
+        "mmap": strip_headers_mmap,
+    }
+    times = dict.fromkeys(functions, 0.)
+    nbooks = 0
+    nbytes = 0
+    tmp_dir = tempfile.mkdtemp()
+    for filename in glob.glob(join(args.raw, 'PG%s_raw.txt' % (args.pattern))):
+        outputs = {}
+        try:
+            for name, f in functions.items():
+                path_out = join(tmp_dir, name + ".txt")
+                t0 = time.perf_counter()
+                f(filename, path_out)
+                times[name] += time.perf_counter() - t0
+                with io.open(path_out, "rb") as f_out:
+                    outputs[name] = f_out.read()
+        except UnicodeDecodeError:
+            continue
+        if len(set(outputs.values())) != 1:
+            raise AssertionError("Outputs differ for '%s'" % filename)
+        nbooks += 1
+        nbytes += os.path.getsize(filename)
+    for name in functions:
+        os.remove(join(tmp_dir, name + ".txt"))
+    os.rmdir(tmp_dir)
+
+    print("%d books, %.1f MB of raw files, identical outputs" % (nbooks, nbytes / 2**20))
+    for name, t in times.items():
+        print("%-8s %8.2f s  %8.1f MB/s" % (name, t, nbytes / 2**20 / max(t, 1e-9)))
@@ -0,0 +1,105 @@
+"""
+Compare tokenize_text_fast with tokenize_text (punkt + Treebank).
+
+Run from the root of the repository, after process_data.py, e.g.
+
+    python -m benchmarks.diff_tokenizers -t data/text/ -p '1*'
+
+Every text file matching the pattern is tokenized with both tokenizers,
+in the language given by the metadata. The report shows the time spent by
+each, how many tokens differ overall, the types that are most often over-
+or under-counted by the fast tokenizer, and the books that differ most.
+The difference between two books is measured on their counts, as the
+number of tokens that would have to be added or removed to turn one into
+the other.
+"""
+import argparse
+import glob
+import io
+import time
+from collections import Counter
+from os.path import join
+
+from src.metadata import get_metadata_path, read_metadata
+from src.parallel import get_language
+from src.tokenizer import tokenize_text, tokenize_text_fast
+from src.utils import get_langs_dict
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Report the differences between the fast and the Treebank tokenizer.")
+    parser.add_argument(
+        "-t", "--text",
+        help="Path to the text-folder",
+        default='data/text/',
+        type=str)
+    parser.add_argument(
+        "-p", "--pattern",
+        help="Patttern to specify a subset of books",
+        default='*',
+        type=str)
+    parser.add_argument(
+        "-n", "--top",
+        help="Number of types and books to list",
+        default=20,
+        type=int)
+    args = parser.parse_args()
+
+    metadata = read_metadata(get_metadata_path("metadata"),
+                             columns=["language"]).set_index("id")
+    langs_dict = get_langs_dict()
+
+    times = {"treebank": 0., "fast": 0.}
+    ntokens = {"treebank": 0, "fast": 0}
+    diff_types = Counter()
+    diff_books = []
+    for filename in glob.glob(join(args.text, 'PG%s_text.txt' % (args.pattern))):
+        PG_id = filename.split("/")[-1].split("_")[0]
+        try:
+            language = get_language(PG_id, metadata, langs_dict)
+        except KeyError:
+            language = "english"
+        with io.open(filename, encoding="UTF-8") as f:
+            text = f.read()
+
+        t0 = time.perf_counter()
+        tokens = tokenize_text(text, language=language)
+        t1 = time.perf_counter()
+        tokens_fast = tokenize_text_fast(text, language=language)
+        t2 = time.perf_counter()
+        times["treebank"] += t1 - t0
+        times["fast"] += t2 - t1
+        ntokens["treebank"] += len(tokens)
+        ntokens["fast"] += len(tokens_fast)
+
+        diff = Counter(tokens_fast)
+        diff.subtract(Counter(tokens))
+        diff = {w: c for w, c in diff.items() if c != 0}
+        diff_types.update(diff)
+        ndiff = sum(abs(c) for c in diff.values())
+        diff_books.append((ndiff / max(len(tokens), 1), ndiff, PG_id, language))
+
+    ndiff = sum(n for _, n, _, _ in diff_books)
+    print("%d books" % len(diff_books))
+    for name in times:
+        print("%-8s %10d tokens  %8.2f s" % (name, ntokens[name], times[name]))
+    print("speedup  %8.1fx" % (times["treebank"] / max(times["fast"], 1e-9)))
+    print("differing tokens: %d (%.3f%% of the Treebank tokens)" % (
+        ndiff, 100. * ndiff / max(ntokens["treebank"], 1)))
+    print("identical books: %d" % sum(1 for _, n, _, _ in diff_books if n == 0))
+
+    print("\nTypes counted more often by the fast tokenizer")
+    for w, c in diff_types.most_common(args.top):
+        if c <= 0:
+            break
+        print("  %-20s %+d" % (w, c))
+    print("\nTypes counted less often by the fast tokenizer")
+    for w, c in sorted(diff_types.items(), key=lambda x: x[1])[:args.top]:
+        if c >= 0:
+            break
+        print("  %-20s %+d" % (w, c))
+    print("\nBooks that differ most")
+    for rel, n, PG_id, language in sorted(diff_books, reverse=True)[:args.top]:
+        print("  %-10s %-10s %8d tokens  %.3f%%" % (PG_id, language, n, 100. * rel))
@@ -0,0 +1,88 @@
+"""
+Export the processed PG data to Parquet.
+
+"""
+import argparse
+import os
+import time
+
+from src.export import export_parquet, BATCH_BYTES
+from src.metadata import get_metadata_path, read_metadata
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Export the processed texts from Project Gutenberg, joined with"
+        " the metadata, to Parquet files partitioned by language.")
+    # text folder
+    parser.add_argument(
+        "-ote", "--output_text",
+        help="Path to text-output (text_dir)",
+        default='data/text/',
+        type=str)
+    # tokens folder
+    parser.add_argument(
+        "-oto", "--output_tokens",
+        help="Path to tokens-output (tokens_dir)",
+        default='data/tokens/',
+        type=str)
+    # metadata
+    parser.add_argument(
+        "-m", "--metadata",
+        help="Path to the metadata, metadata.parquet or metadata.csv"
+             " (default: metadata/metadata.parquet if it exists)",
+        default=None,
+        type=str)
+    # export folder
+    parser.add_argument(
+        "-o", "--output",
+        help="Path to the folder of the export (must not exist or be empty)",
+        default='data/parquet/',
+        type=str)
+    # include tokens
+    parser.add_argument(
+        "--tokens",
+        action="store_true",
+        help="Include the list of tokens of every book")
+    # how the levels were written
+    parser.add_argument(
+        "-pk", "--pack",
+        action="store_true",
+        help="The text and tokens were written with --pack")
+    parser.add_argument(
+        "-z", "--compression",
+        help="Compression the text and tokens were written with",
+        choices=["none", "gzip", "zstd"],
+        default="none",
+        type=str)
+    # memory
+    parser.add_argument(
+        "-bmb", "--batch_mb",
+        help="Approximate memory (in MB) of the rows held before writing",
+        default=BATCH_BYTES / 2**20,
+        type=float)
+    # quiet argument, to supress info
+    parser.add_argument(
+        "-q", "--quiet",
+        action="store_true",
+        help="Quiet mode, do not print info, warnings, etc"
+    )
+    args = parser.parse_args()
+
+    compression = None
+    if args.compression != "none":
+        compression = args.compression
+
+    t_start = time.perf_counter()
+    if args.metadata is None:
+        args.metadata = get_metadata_path("metadata")
+    metadata = read_metadata(args.metadata).set_index("id")
+    os.makedirs(args.output, exist_ok=True)
+    nbooks = export_parquet(
+        args.output, metadata, args.output_text, args.output_tokens,
+        pack=args.pack, compression=compression, tokens=args.tokens,
+        batch_bytes=int(args.batch_mb * 2**20))
+    if not args.quiet:
+        print("Exported %d books to '%s' in %.1f s" % (
+            nbooks, args.output, time.perf_counter() - t_start))
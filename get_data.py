@@ -5,7 +5,9 @@ Written by
 M. Gerlach & F. Font-Clos
 
 """
-from src.utils import populate_raw_from_mirror, list_duplicates_in_mirror
+from src.mirror import scan_mirror, populate_raw, diff_mirror_index
+from src.mirror import read_mirror_index, write_mirror_index
+from src.changefeed import write_changefeed
 from src.metadataparser import make_df_metadata
 from src.bookshelves import get_bookshelves
 from src.bookshelves import parse_bookshelves
@@ -14,6 +16,7 @@ import argparse
 import os
 import subprocess
 import pickle
+import time
 
 if __name__ == '__main__':
 
@@ -56,12 +59,47 @@ if __name__ == '__main__':
         action="store_false",
         help="If there is an RDF file in metadata dir, do not overwrite it.")
 
+    # mirror index
+    parser.add_argument(
+        "-mi", "--mirror_index",
+        help="Path to the index of the books in the mirror, written after"
+             " every update ('' to not write it).",
+        default='data/mirror_index.tsv',
+        type=str)
+
     # update argument
     parser.add_argument(
         "-owr", "--overwrite_raw",
         action="store_true",
         help="Overwrite files in raw.")
 
+    # number of processes parsing the RDF files
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of worker processes parsing the metadata, and of"
+             " threads listing the mirror (default: 1, no parallelism)",
+        default=1,
+        type=int)
+
+    # store of parsed RDF files
+    parser.add_argument(
+        "-st", "--store",
+        help="Path to the store of parsed RDF files, so that only the new or"
+             " changed ones are parsed (default: records.sqlite in the"
+             " metadata folder; '' to parse all of them)",
+        default=None,
+        type=str)
+
+    # changefeed for process_data.py
+    parser.add_argument(
+        "-cf", "--changefeed",
+        help="Path to the changefeed to which the books added, modified or"
+             " removed in the mirror (needs the mirror index) and in the"
+             " metadata (needs the store) are appended (default:"
+             " changefeed.tsv in the metadata folder; '' to not write it).",
+        default=None,
+        type=str)
+
     # quiet argument, to supress info
     parser.add_argument(
         "-q", "--quiet",
@@ -71,6 +109,10 @@ if __name__ == '__main__':
 
     # create the parser
     args = parser.parse_args()
+    if args.store is None:
+        args.store = os.path.join(args.metadata, 'records.sqlite')
+    if args.changefeed is None:
+        args.changefeed = os.path.join(args.metadata, 'changefeed.tsv')
 
     # check that all dirs exist
     if not os.path.isdir(args.mirror):
@@ -107,35 +149,68 @@ if __name__ == '__main__':
                ]
     subprocess.call(sp_args)
 
-    # Get rid of duplicates
-    # ---------------------
-    # A very small portion of books are stored more than
-    # once in PG's site. We keep the newest one, see
-    # erase_duplicates_in_mirror docstring.
-    dups_list = list_duplicates_in_mirror(mirror_dir=args.mirror)
+    # Index the mirror
+    # ----------------
+    # The mirror is listed in a single pass. A very small
+    # portion of books are stored more than once in PG's
+    # site. We keep the 12345-0.txt one, see scan_mirror
+    # docstring.
+    t_start = time.perf_counter()
+    index, duplicates = scan_mirror(args.mirror, workers=args.workers)
+    if not args.quiet:
+        for path in duplicates:
+            print("# WARNING: file %s skipped due to duplication"
+                  % os.path.basename(path))
 
     # Populate raw from mirror
     # ------------------------
     # We populate 'raw_dir' hardlinking to
     # the hidden 'mirror_dir'. Names are standarized
     # into PG12345_raw.txt form.
-    populate_raw_from_mirror(
-        mirror_dir=args.mirror,
-        raw_dir=args.raw,
-        overwrite=args.overwrite_raw,
-        dups_list=dups_list,
-        quiet=args.quiet
-        )
+    stats = populate_raw(
+        args.mirror, args.raw, index, overwrite=args.overwrite_raw)
+
+    # The books added, updated or removed since the
+    # previous index go to the changefeed.
+    changes = []
+    if args.mirror_index != "":
+        changes = diff_mirror_index(
+            read_mirror_index(args.mirror_index), index)
+        if args.changefeed != "":
+            write_changefeed(args.changefeed, changes)
+        write_mirror_index(args.mirror_index, index)
+    if not args.quiet:
+        print("Raw: %d books in the mirror, %d linked, %d linked again,"
+              " %d failed, %d changes (%.1f s)" % (
+                  len(index), stats['linked'], stats['relinked'],
+                  stats['failed'], len(changes),
+                  time.perf_counter() - t_start))
 
     # Update metadata
     # ---------------
     # By default, update the whole metadata csv
-    # file each time new data is downloaded.
-    make_df_metadata(
+    # file each time new data is downloaded. Only the
+    # RDF files that changed since the last update are
+    # parsed, and the books whose metadata changed go
+    # to the changefeed.
+    timings = make_df_metadata(
         path_xml=os.path.join(args.metadata, 'rdf-files.tar.bz2'),
         path_out=os.path.join(args.metadata, 'metadata.csv'),
-        update=args.keep_rdf
+        path_parquet=os.path.join(args.metadata, 'metadata.parquet'),
+        update=args.keep_rdf,
+        workers=args.workers,
+        path_store=args.store or None,
+        path_changefeed=(args.store and args.changefeed) or None
         )
+    if not args.quiet:
+        print("Metadata: parsed %d RDF files (%d unchanged)" % (
+            timings['parsed'], timings['cached']))
+        print("  download %.1f s, decompress %.1f s, parse %.1f s"
+              " (summed over %d workers), dataframe %.1f s, csv %.1f s,"
+              " parquet %.1f s" % (
+                  timings['download'], timings['decompress'],
+                  timings['parse'], args.workers, timings['dataframe'],
+                  timings['csv'], timings['parquet']))
 
     # Bookshelves
     # -----------
@@ -8,12 +8,19 @@ M. Gerlach and F. Font-Clos
 import os
 from os.path import join
 import argparse
+import fnmatch
 import glob
-import ast
-import pandas as pd
+import time
 
-from src.pipeline import process_book
-from src.utils import get_langs_dict
+from src.changefeed import (claim_changefeed, read_changefeed,
+                            release_changefeed, MODIFIED, REMOVED)
+from src.cleanup import strip_headers_file, strip_headers_mmap
+from src.manifest import Manifest
+from src.metadata import get_metadata_path
+from src.matrix import update_matrix
+from src.tokenizer import tokenize_text, tokenize_text_fast
+from src.parallel import process_files, ERROR_ENCODING, ERROR_METADATA
+from src.watch import RawWatcher
 
 
 if __name__ == '__main__':
@@ -45,6 +52,26 @@ if __name__ == '__main__':
         help="Path to counts-output (counts_dir)",
         default='data/counts/',
         type=str)
+    # ids folder
+    parser.add_argument(
+        "-oid", "--output_ids",
+        help="Path to ids-output (ids_dir): the id of every token in the"
+             " vocabulary, as a numpy array per book (default: not written)",
+        default='',
+        type=str)
+    # matrix folder
+    parser.add_argument(
+        "-omat", "--output_matrix",
+        help="Path to matrix-output: the counts of all books as a single"
+             " sparse matrix, updated after processing (default: not written)",
+        default='',
+        type=str)
+    # vocabulary
+    parser.add_argument(
+        "-voc", "--vocabulary",
+        help="Path to the vocabulary giving the ids of the ids-output",
+        default='data/vocabulary.txt',
+        type=str)
     # pattern to specify subset of books
     parser.add_argument(
         "-p", "--pattern",
@@ -52,6 +79,42 @@ if __name__ == '__main__':
         default='*',
         type=str)
 
+    # how to strip headers
+    parser.add_argument(
+        "-c", "--cleanup",
+        help="How to remove headers and footers: 'memory' reads the whole"
+             " raw file into memory, 'stream' reads it line by line, 'mmap'"
+             " memory-maps it and copies the body without splitting lines",
+        choices=["memory", "stream", "mmap"],
+        default="memory",
+        type=str)
+
+    # tokenizer
+    parser.add_argument(
+        "-t", "--tokenizer",
+        help="Tokenizer: 'treebank' (punkt and NLTK's Treebank tokenizer)"
+             " or 'fast' (a single regex, see tokenize_text_fast)",
+        choices=["treebank", "fast"],
+        default="treebank",
+        type=str)
+
+    # pack the text, tokens and counts levels
+    parser.add_argument(
+        "-pk", "--pack",
+        action="store_true",
+        help="Append the text, tokens and counts of the books to a few"
+             " large shard files in each output folder, instead of writing"
+             " a file per book")
+
+    # compress the text, tokens and counts levels
+    parser.add_argument(
+        "-z", "--compression",
+        help="Compress the text, tokens and counts of the books with gzip"
+             " or zstd (which needs the zstandard package)",
+        choices=["none", "gzip", "zstd"],
+        default="none",
+        type=str)
+
     # quiet argument, to supress info
     parser.add_argument(
         "-q", "--quiet",
@@ -59,6 +122,80 @@ if __name__ == '__main__':
         help="Quiet mode, do not print info, warnings, etc"
     )
 
+    # number of worker processes
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of worker processes (default: 1, no parallelism)",
+        default=1,
+        type=int)
+
+    # memory budget for the books being processed at the same time
+    parser.add_argument(
+        "-mb", "--memory_budget",
+        help="Approximate memory (in MB) that the books being processed"
+             " at the same time may use (default: no limit)",
+        default=None,
+        type=float)
+
+    # manifest of processed books
+    parser.add_argument(
+        "-man", "--manifest",
+        help="Path to the manifest of processed books, used to process"
+             " only new or changed books ('' to always check output files)",
+        default="data/manifest.sqlite",
+        type=str)
+
+    # changefeed
+    parser.add_argument(
+        "-cf", "--changefeed",
+        help="Path to a changefeed (e.g. metadata/changefeed.tsv, written by"
+             " get_data.py): only process the books added or modified in it,"
+             " processing the modified ones again even if up to date, and"
+             " remove them from it at the end (books that were skipped or"
+             " failed stay for the next run; default: not used)",
+        default="",
+        type=str)
+
+    # watch mode
+    parser.add_argument(
+        "-wa", "--watch",
+        action="store_true",
+        help="Keep running, and process the raw files as they appear in the"
+             " raw-folder (e.g. while get_data.py runs), until interrupted"
+             " or --watch_timeout")
+    parser.add_argument(
+        "-wi", "--watch_interval",
+        help="Seconds between two looks at the raw-folder in watch mode",
+        default=10.,
+        type=float)
+    parser.add_argument(
+        "-ws", "--watch_settle",
+        help="Seconds a raw file must not have been modified for to be"
+             " processed in watch mode, so that files still being written"
+             " are not",
+        default=5.,
+        type=float)
+    parser.add_argument(
+        "-wm", "--watch_mirror",
+        help="Path to the mirror (e.g. data/.mirror/): in watch mode, link"
+             " the books downloaded to it into the raw-folder, so that they"
+             " are processed while the rest are being downloaded (default:"
+             " only watch the raw-folder)",
+        default='',
+        type=str)
+    parser.add_argument(
+        "-wt", "--watch_timeout",
+        help="Stop watching after this many seconds without new raw files"
+             " (default: never)",
+        default=None,
+        type=float)
+
+    # overwrite argument
+    parser.add_argument(
+        "-owa", "--overwrite_all",
+        action="store_true",
+        help="Process all books, even if they are up to date")
+
     # log file
     parser.add_argument(
         "-l", "--log_file",
@@ -68,6 +205,8 @@ if __name__ == '__main__':
 
     # add arguments to parser
     args = parser.parse_args()
+    if args.watch and args.changefeed != "":
+        parser.error("--watch and --changefeed cannot be used together")
 
     # check whether the out-put directories exist
     if os.path.isdir(args.output_text) is False:
@@ -79,49 +218,162 @@ if __name__ == '__main__':
     if os.path.isdir(args.output_counts) is False:
         raise ValueError("The directory for output of counts '%s' "
                          "does not exist" % (args.output_counts))
+    ids_dir = None
+    if args.output_ids != "":
+        if os.path.isdir(args.output_ids) is False:
+            raise ValueError("The directory for output of ids '%s' "
+                             "does not exist" % (args.output_ids))
+        ids_dir = args.output_ids
+    if args.output_matrix != "" and os.path.isdir(args.output_matrix) is False:
+        raise ValueError("The directory for output of the matrix '%s' "
+                         "does not exist" % (args.output_matrix))
+
+    # memory budget in bytes
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 2**20)
+
+    # write text files straight from raw files
+    cleanup_file_f = None
+    if args.cleanup == "stream":
+        cleanup_file_f = strip_headers_file
+    elif args.cleanup == "mmap":
+        cleanup_file_f = strip_headers_mmap
+
+    # compression of the output
+    compression = None
+    if args.compression != "none":
+        compression = args.compression
+
+    # tokenizer
+    tokenize_f = tokenize_text
+    if args.tokenizer == "fast":
+        tokenize_f = tokenize_text_fast
+
+    # manifest of processed books
+    manifest = None
+    if args.manifest != "":
+        manifest = Manifest(args.manifest)
+    elif os.path.isfile(parser.get_default("manifest")):
+        # the books processed now are not recorded in the default manifest,
+        # which then no longer lists all the processed books
+        Manifest(parser.get_default("manifest")).set_complete(False)
 
-    # load metadata
-    metadata = pd.read_csv("metadata/metadata.csv").set_index("id")
+    # books to process: all books in the raw-folder, or those in the
+    # changefeed
+    filenames = glob.iglob(join(args.raw, 'PG%s_raw.txt' % (args.pattern)))
+    refresh = None
+    changes = None
+    if args.changefeed != "":
+        # changes appended from now on are left for the next run
+        claimed = claim_changefeed(args.changefeed)
+        changes = read_changefeed(claimed)
+        filenames = []
+        # books left in the changefeed: those skipped here, and those
+        # that fail
+        pending = []
+        for PG_id, status in changes.items():
+            if status == REMOVED:
+                continue
+            filename = join(args.raw, '%s_raw.txt' % PG_id)
+            if not os.path.exists(filename) or \
+                    not fnmatch.fnmatch(os.path.basename(filename),
+                                        'PG%s_raw.txt' % (args.pattern)):
+                pending.append(PG_id)
+                continue
+            filenames.append(filename)
+        refresh = [PG_id for PG_id, status in changes.items()
+                   if status == MODIFIED]
+        # books removed from the catalog are forgotten, but their outputs
+        # are kept
+        if manifest is not None:
+            for PG_id, status in changes.items():
+                if status == REMOVED:
+                    manifest.remove(PG_id)
+        if not args.quiet:
+            print("%d books in the changefeed, %d to process" % (
+                len(changes), len(filenames)))
 
-    # load languages dict
-    langs_dict = get_langs_dict()
+    # or the raw files as they appear
+    watcher = None
+    if args.watch:
+        watcher = RawWatcher(
+            args.raw, pattern=args.pattern, settle=args.watch_settle,
+            mirror_dir=args.watch_mirror or None,
+            idle_timeout=args.watch_timeout,
+            metadata_path=get_metadata_path("metadata"))
+        if not args.quiet:
+            print("Watching %s for raw files..." % args.raw)
 
     # loop over all books in the raw-folder
     pbooks = 0
-    for filename in glob.glob(join(args.raw, 'PG%s_raw.txt' % (args.pattern))):
-        # The process_books function will fail very rarely, whne
-        # a file tagged as UTf-8 is not really UTF-8. We kust
-        # skip those books.
-        try:
-            # get PG_id
-            PG_id = filename.split("/")[-1].split("_")[0]
-
-            # get language from metadata
-            # default is english
-            language = "english"
-            # language is a string representing a list of languages codes
-            lang_id = ast.literal_eval(metadata.loc[PG_id, "language"])[0]
-            if lang_id in langs_dict.keys():
-                language = langs_dict[lang_id]
-
-            # process the book: strip headers, tokenize, count
-            process_book(
-                path_to_raw_file=filename,
-                text_dir=args.output_text,
-                tokens_dir=args.output_tokens,
-                counts_dir=args.output_counts,
-                language=language,
-                log_file=args.log_file
-            )
+    # seconds spent warming up each worker process, by pid,
+    # and processing books, over all processes
+    warmup = {}
+    busy = 0.
+    t_start = time.perf_counter()
+    for filename, error, _, timings in process_files(
+            filenames,
+            workers=args.workers,
+            memory_budget=memory_budget,
+            manifest=manifest,
+            path_metadata=get_metadata_path("metadata"),
+            text_dir=args.output_text,
+            tokens_dir=args.output_tokens,
+            counts_dir=args.output_counts,
+            ids_dir=ids_dir,
+            vocabulary_file=args.vocabulary,
+            cleanup_file_f=cleanup_file_f,
+            tokenize_f=tokenize_f,
+            overwrite_all=args.overwrite_all,
+            refresh=refresh,
+            watcher=watcher,
+            poll_interval=args.watch_interval,
+            pack=args.pack,
+            compression=compression,
+            log_file=args.log_file):
+        if timings["warmup"] is not None:
+            warmup[timings["pid"]] = timings["warmup"]
+        busy += timings["process"]
+        if error is not None and changes is not None:
+            pending.append(os.path.basename(filename).split("_")[0])
+        if error is None:
             pbooks += 1
             if not args.quiet:
                 print("Processed %d books..." % pbooks, end="\r")
-        except UnicodeDecodeError:
-            if not args.quiet:
-                print("# WARNING: cannot process '%s' (encoding not UTF-8)" % filename)
-        except KeyError:
-            if not args.quiet:
-                print("# WARNING: metadata for '%s' not found" % filename)
-        except Exception as e:
-            if not args.quiet:
-                print("# WARNING: cannot process '%s' (unkown error)" % filename)
+        elif args.quiet:
+            pass
+        elif error == ERROR_ENCODING:
+            print("# WARNING: cannot process '%s' (encoding not UTF-8)" % filename)
+        elif error == ERROR_METADATA:
+            print("# WARNING: metadata for '%s' not found" % filename)
+        else:
+            print("# WARNING: cannot process '%s' (unkown error)" % filename)
+
+    if manifest is not None:
+        # after a run over the whole raw folder, every processed book has a
+        # record, including those processed before the manifest existed
+        if args.pattern == '*' and args.changefeed == "":
+            manifest.set_complete()
+        manifest.close()
+    if changes is not None:
+        release_changefeed(
+            claimed, [(changes[PG_id], PG_id) for PG_id in pending])
+
+    if not args.quiet:
+        print("Processed %d books in %.1f s" % (
+            pbooks, time.perf_counter() - t_start))
+        if warmup:
+            print("  worker warm-up: %.2f s in each of %d processes" % (
+                sum(warmup.values()) / len(warmup), len(warmup)))
+        print("  processing books: %.1f s in total" % busy)
+
+    # add the new and changed books to the matrix of counts
+    if args.output_matrix != "":
+        t_matrix = time.perf_counter()
+        nrows = update_matrix(
+            args.output_counts, args.output_matrix,
+            vocabulary_file=args.vocabulary, pack=args.pack)
+        if not args.quiet:
+            print("Updated %d books in the matrix in %.1f s" % (
+                nrows, time.perf_counter() - t_matrix))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Record which books were added, modified or removed, for process_data.py.
+
+A changefeed is a tab-separated file with one line per change,
+
+    added	PG12345
+    modified	PG42
+    removed	PG7
+
+to which new changes are appended (e.g. by every run of get_data.py) until
+they are consumed (e.g. by process_data.py --changefeed). The consumer first
+moves the changes aside (claim_changefeed), so that changes appended while
+it runs stay in the changefeed, and at the end puts back the changes it did
+not consume (release_changefeed), e.g. those of books that failed.
+"""
+import os
+import shutil
+import tempfile
+
+ADDED = "added"
+MODIFIED = "modified"
+REMOVED = "removed"
+STATUSES = (ADDED, MODIFIED, REMOVED)
+
+
+def diff_records(old, new):
+    """
+    Compare two versions of a set of records.
+
+    Parameters
+    ----------
+    old, new : dict
+        PG id to record (anything that can be compared with ==).
+
+    Returns
+    -------
+    list of (str, str)
+        (status, PG_id) of the ids only in new (ADDED), in both with
+        different records (MODIFIED), and only in old (REMOVED), in the
+        order of new and then of old.
+    """
+    changes = []
+    for PG_id, record in new.items():
+        if PG_id not in old:
+            changes.append((ADDED, PG_id))
+        elif old[PG_id] != record:
+            changes.append((MODIFIED, PG_id))
+    for PG_id in old:
+        if PG_id not in new:
+            changes.append((REMOVED, PG_id))
+    return changes
+
+
+def write_changefeed(path, changes):
+    """
+    Append changes to a changefeed, creating it if it does not exist.
+
+    Parameters
+    ----------
+    path : str
+        Path to the changefeed.
+    changes : iterable of (str, str)
+        (status, PG_id), with status one of STATUSES.
+    """
+    with open(path, "a", encoding="UTF-8") as f:
+        for status, PG_id in changes:
+            if status not in STATUSES:
+                raise ValueError("Unknown status of a change: %r" % status)
+            f.write("%s\t%s\n" % (status, PG_id))
+
+
+def read_changefeed(path):
+    """
+    Read the changes in a changefeed.
+
+    Returns
+    -------
+    dict
+        PG_id to its status (of the last change of the book, except that
+        a book added and then modified stays ADDED), in the order in
+        which the books first appear. Empty if the changefeed does not
+        exist.
+    """
+    changes = {}
+    if not os.path.exists(path):
+        return changes
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            # ignore a line that is still being written
+            if len(fields) != 2 or fields[0] not in STATUSES:
+                continue
+            status, PG_id = fields
+            if status == MODIFIED and changes.get(PG_id) == ADDED:
+                continue
+            changes[PG_id] = status
+    return changes
+
+
+def claim_changefeed(path):
+    """
+    Move the changes of a changefeed aside, before they are consumed.
+
+    The changes are appended to path + '.claimed', after the changes left
+    there by the previous consumer (see release_changefeed). Changes
+    appended to the changefeed from then on go to a new file at path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the changefeed.
+
+    Returns
+    -------
+    str
+        Path to the claimed changes, to read with read_changefeed.
+    """
+    claimed = path + ".claimed"
+    moving = path + ".moving"
+    # renaming is atomic; a file left at moving by an interrupted claim is
+    # appended first, and the changefeed at the next claim
+    if os.path.exists(path) and not os.path.exists(moving):
+        os.rename(path, moving)
+    if os.path.exists(moving):
+        with open(moving, encoding="UTF-8") as f_in, \
+                open(claimed, "a", encoding="UTF-8") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(moving)
+    return claimed
+
+
+def release_changefeed(claimed, changes):
+    """
+    Replace the claimed changes by those that were not consumed, at once.
+
+    Parameters
+    ----------
+    claimed : str
+        Path to the claimed changes (see claim_changefeed).
+    changes : iterable of (str, str)
+        (status, PG_id) of the changes not consumed, kept for the next
+        consumer. If there are none, the claimed changes are removed.
+    """
+    changes = list(changes)
+    if not changes:
+        if os.path.exists(claimed):
+            os.remove(claimed)
+        return
+    fd, path_tmp = tempfile.mkstemp(
+        dir=os.path.dirname(claimed) or ".", suffix=".tmp")
+    os.close(fd)
+    write_changefeed(path_tmp, changes)
+    os.replace(path_tmp, claimed)
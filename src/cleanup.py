@@ -2,8 +2,11 @@
 """Taken from https://github.com/c-w/gutenberg/."""
 
 from __future__ import unicode_literals
+import codecs
 import os
 import io
+import mmap
+import re
 
 
 def cleanup(path, text_dir):
@@ -17,13 +20,8 @@ def cleanup(path, text_dir):
 
     """
     PG_number = path.split("/")[-1].split("_")[0][2:]
-    with io.open(path) as f:
-        text = f.read()
-
-    clean = strip_headers(text)
     source_file = os.path.join(text_dir, "PG%s_text.txt" % PG_number)
-    with io.open(source_file, "w") as f:
-        f.write(clean)
+    strip_headers_file(path, source_file)
 
 
 ############
@@ -119,6 +117,26 @@ LEGALESE_START_MARKERS = frozenset(("<<THIS ELECTRONIC VERSION OF",))
 LEGALESE_END_MARKERS = frozenset(("SERVICE THAT CHARGES FOR DOWNLOAD",))
 
 
+def compile_markers(markers):
+    """
+    Compile a set of markers into a single regex.
+
+    For any line, regex.match(line) succeeds exactly when
+    line.startswith(marker) for some marker in markers. Checking a line
+    then takes a single call instead of one startswith call per marker.
+    """
+    if not markers:
+        # never matches
+        return re.compile("(?!)")
+    return re.compile("|".join(re.escape(marker) for marker in sorted(markers)))
+
+
+TEXT_START_RE = compile_markers(TEXT_START_MARKERS)
+TEXT_END_RE = compile_markers(TEXT_END_MARKERS)
+LEGALESE_START_RE = compile_markers(LEGALESE_START_MARKERS)
+LEGALESE_END_RE = compile_markers(LEGALESE_END_MARKERS)
+
+
 def strip_headers(text):
     """
     Remove lines that are part of the Project Gutenberg header or footer.
@@ -134,11 +152,34 @@ def strip_headers(text):
         unicode: The text with any non-text content removed.
 
     """
-    lines = text.splitlines()
     sep = str(os.linesep)
+    return sep.join(iter_stripped_lines(text.splitlines()))
+
+
+def iter_stripped_lines(lines, start=0):
+    """
+    Remove lines that are part of the Project Gutenberg header or footer.
+
+    This is the line by line version of strip_headers. Lines are yielded
+    as soon as they are known to be part of the text: the end of the header
+    may be found anywhere within the first 600 lines of output, so those
+    are buffered, and every later line is yielded right away.
+
+    Args:
+        lines (iterable of unicode): The lines of the text, as given by
+            splitlines (i.e. without line breaks).
+        start (int): Number of lines of output already produced, to resume
+            the cleanup of a text in the middle. Lines before the end of the
+            header must not be resumed, i.e. start must be 0 or above 600.
+
+    Yields:
+        unicode: The lines of the text, with any non-text content removed.
 
-    out = []
-    i = 0
+    """
+    sep = str(os.linesep)
+
+    out = [] if start <= 600 else None
+    i = start
     footer_found = False
     ignore_section = False
 
@@ -147,7 +188,7 @@ def strip_headers(text):
 
         if i <= 600:
             # Check if the header ends here
-            if any(line.startswith(token) for token in TEXT_START_MARKERS):
+            if TEXT_START_RE.match(line):
                 reset = True
 
             # If it's the end of the header, delete the output produced so far.
@@ -159,22 +200,236 @@ def strip_headers(text):
 
         if i >= 100:
             # Check if the footer begins here
-            if any(line.startswith(token) for token in TEXT_END_MARKERS):
+            if TEXT_END_RE.match(line):
                 footer_found = True
 
             # If it's the beginning of the footer, stop output
             if footer_found:
                 break
 
-        if any(line.startswith(token) for token in LEGALESE_START_MARKERS):
+        if LEGALESE_START_RE.match(line):
             ignore_section = True
             continue
-        elif any(line.startswith(token) for token in LEGALESE_END_MARKERS):
+        elif LEGALESE_END_RE.match(line):
             ignore_section = False
             continue
 
         if not ignore_section:
-            out.append(line.rstrip(sep))
             i += 1
+            if out is None:
+                yield line.rstrip(sep)
+            else:
+                out.append(line.rstrip(sep))
+                # past this point the header can not end anymore,
+                # so the buffered output is final
+                if i > 600:
+                    for buffered in out:
+                        yield buffered
+                    out = None
+
+    if out is not None:
+        for buffered in out:
+            yield buffered
+
+
+def strip_headers_file(path_in, path_out):
+    """
+    Remove the Project Gutenberg header and footer of a file.
+
+    The output is the same as writing strip_headers of the whole file, but
+    the file is read and written line by line, so the memory needed does
+    not depend on the size of the book. The rest of the file after the
+    footer is still decoded, so that a file that is not valid UTF-8 raises
+    UnicodeDecodeError as it does with strip_headers.
+
+    Args:
+        path_in (str): Path to the raw file, encoded as UTF-8.
+        path_out (str): Path to the text file to write.
+
+    """
+    sep = str(os.linesep)
+    # newline="" keeps \r\n together, and splitlines below breaks lines
+    # on the same characters as strip_headers does
+    with io.open(path_in, encoding="UTF-8", newline="") as f_in, \
+            io.open(path_out, "w", encoding="UTF-8") as f_out:
+        lines = (line for chunk in f_in for line in chunk.splitlines())
+        first = True
+        for line in iter_stripped_lines(lines):
+            if not first:
+                f_out.write(sep)
+            f_out.write(line)
+            first = False
+        # decode what is left after the footer
+        for _ in iter(lambda: f_in.read(2**20), ""):
+            pass
+
+
+# lines that change the state of iter_stripped_lines once past the header,
+# found after the preceding line break (faster to search for than ^)
+_BODY_MARKERS_BYTES_RE = re.compile(
+    b"\n(?:" + b"|".join(
+        re.escape(marker.encode("UTF-8")) for marker in sorted(
+            TEXT_END_MARKERS | LEGALESE_START_MARKERS | LEGALESE_END_MARKERS)
+    ) + b")")
+# line breaks of splitlines other than \n, once \r\n is replaced by \n
+_OTHER_LINE_BREAKS = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def _iter_mmap_lines(mm, pos, state=None):
+    """
+    Yield the lines of a memory-mapped UTF-8 file, as splitlines would.
+
+    The file is read from byte pos on, one \\n-terminated chunk at a time.
+    If a state dict is given, state["pos"] is kept at the end of the last
+    chunk read, state["split"] tells whether some lines of that chunk are
+    still to be yielded, state["last"] is the last line yielded, and
+    setting state["stop"] stops the iteration at the end of the current
+    chunk.
+    """
+    size = len(mm)
+    while pos < size:
+        if state is not None and state.get("stop"):
+            return
+        end = mm.find(b"\n", pos)
+        end = size if end < 0 else end + 1
+        lines = mm[pos:end].decode("UTF-8").splitlines()
+        pos = end
+        for k, line in enumerate(lines):
+            if state is not None:
+                state["pos"] = pos
+                state["split"] = k < len(lines) - 1
+                state["last"] = line
+            yield line
+
+
+class _LineWriter(object):
+    """Write lines to a text file, joined by a separator."""
+
+    def __init__(self, f, sep):
+        self.f = f
+        self.sep = sep
+        self.first = True
+
+    def write_line(self, line):
+        if not self.first:
+            self.f.write(self.sep)
+        self.f.write(line)
+        self.first = False
+
+    def write_block(self, block):
+        """Write several lines, given as a string joined by \\n."""
+        if self.sep != "\n":
+            block = block.replace("\n", self.sep)
+        self.write_line(block)
+
+
+def strip_headers_mmap(path_in, path_out, blocksize=2**20):
+    """
+    Remove the Project Gutenberg header and footer of a file.
+
+    The output is the same as writing strip_headers of the whole file. Only
+    the lines up to the point where the header can not end anymore (600
+    lines of output) are processed one by one in Python. From there on the
+    raw file is memory-mapped and searched with a single regex for the
+    first line starting with a footer or legalese marker; everything before
+    that line is part of the text and is copied in blocks, without being
+    split into lines.
+
+    From the first block that has line breaks other than \\n and \\r\\n,
+    or from the first legalese marker, the remaining lines are processed
+    one by one as in strip_headers_file. The rest of the file after the
+    footer is then decoded in blocks, so that a file that is not valid
+    UTF-8 raises UnicodeDecodeError as it does with strip_headers.
+
+    Args:
+        path_in (str): Path to the raw file, encoded as UTF-8.
+        path_out (str): Path to the text file to write.
+        blocksize (int): Approximate size in bytes of the blocks copied.
+
+    """
+    if os.path.getsize(path_in) == 0:
+        # empty files can not be memory-mapped
+        strip_headers_file(path_in, path_out)
+        return
+
+    with io.open(path_in, "rb") as f_in:
+        mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with io.open(path_out, "w", encoding="UTF-8") as f_out:
+            pos = _strip_mmap(mm, _LineWriter(f_out, str(os.linesep)),
+                              blocksize)
+        # the lines after the footer are not read, but must be UTF-8 too
+        decoder = codecs.getincrementaldecoder("UTF-8")()
+        for block_start in range(pos, len(mm), blocksize):
+            decoder.decode(mm[block_start:block_start + blocksize])
+        decoder.decode(b"", final=True)
+    finally:
+        mm.close()
+
+
+def _strip_mmap(mm, writer, blocksize):
+    """
+    Write the text of a memory-mapped raw file (see strip_headers_mmap).
+
+    Returns
+    -------
+    int
+        The position in mm up to which the file was read (after a line
+        break, or at the end).
+    """
+    # The header: lines are buffered until 600 lines of output are
+    # produced, and then all of them are yielded at once. When that
+    # happens, stop reading lines at the end of the current chunk;
+    # the rest of the generator is the buffered lines.
+    state = {"pos": 0, "split": False, "last": ""}
+    lines = iter_stripped_lines(_iter_mmap_lines(mm, 0, state))
+    for line in lines:
+        state["stop"] = not state["split"]
+        writer.write_line(line)
+        break
+    for line in lines:
+        writer.write_line(line)
+    if not state.get("stop") or TEXT_END_RE.match(state["last"]):
+        # Either the header ended in the middle of a chunk and the
+        # whole file was done line by line, or the output was
+        # yielded because the footer was found (the line that ends
+        # the header is part of the output, so it is never a footer
+        # marker), or the whole file was read.
+        return state["pos"]
+
+    # The body, from the end of the header to the first marker.
+    pos = state["pos"]
+    # pos is right after a \n (or at the end of the file)
+    match = _BODY_MARKERS_BYTES_RE.search(mm, pos - 1)
+    end = len(mm) if match is None else match.start() + 1
+    while pos < end:
+        block_end = end
+        if end - pos > blocksize:
+            # cut after a \n, so that lines and UTF-8
+            # characters are not split between blocks
+            block_end = mm.rfind(b"\n", pos, pos + blocksize) + 1
+            if block_end <= pos:
+                block_end = mm.find(b"\n", pos + blocksize, end) + 1
+                if block_end <= pos:
+                    block_end = end
+        block = mm[pos:block_end].decode("UTF-8").replace("\r\n", "\n")
+        if any(c in block for c in _OTHER_LINE_BREAKS):
+            # lines are not simply separated by \n here
+            break
+        if block.endswith("\n"):
+            block = block[:-1]
+        writer.write_block(block)
+        pos = block_end
+
+    # Whatever is left (starting with the marker, if any).
+    state = {"pos": pos}
+    for line in iter_stripped_lines(
+            _iter_mmap_lines(mm, pos, state), start=601):
+        writer.write_line(line)
+    return state["pos"]
+
 
-    return sep.join(out)
+# bump whenever a change to strip_headers changes its output
+strip_headers.version = 1
+strip_headers_file.version = strip_headers.version
+strip_headers_mmap.version = strip_headers.version
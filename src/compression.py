@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Read and write the text, tokens and counts levels compressed.
+
+Two compressions are supported: gzip, from the standard library, and zstd,
+which is much faster for a similar ratio but needs the zstandard package
+(pip install zstandard). A compressed file has the suffix of its
+compression added to its name, e.g. PG12345_text.txt.gz, and is read and
+written in streaming fashion. Books in a pack (see packs.py) are compressed
+one by one, and are recognized when read by the magic bytes at their start,
+which cannot start a UTF-8 text.
+"""
+import gzip
+import io
+
+# suffix of the files of each compression
+SUFFIXES = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+# compression levels, chosen for speed rather than ratio
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _zstandard():
+    """Import zstandard, which is only needed for zstd."""
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression needs the zstandard package "
+            "(pip install zstandard)")
+    return zstandard
+
+
+def get_compression(path):
+    """Get the compression of a file from its suffix (None if plain)."""
+    for compression, suffix in SUFFIXES.items():
+        if suffix and path.endswith(suffix):
+            return compression
+    return None
+
+
+def open_compressed(path, mode="r", compression=None):
+    """
+    Open a possibly compressed file as a text file, in UTF-8.
+
+    The file is decompressed (or compressed) as it is read (or written).
+
+    Parameters
+    ----------
+    path : str
+        Path to the file, including the suffix of its compression.
+    mode : str
+        'r' to read or 'w' to write.
+    compression : str or None
+        None, 'gzip' or 'zstd'. When reading, None means that the
+        compression is given by the suffix of path.
+
+    Returns
+    -------
+    file object
+    """
+    if mode not in ("r", "w"):
+        raise ValueError("mode must be 'r' or 'w', not %r" % mode)
+    if compression is None and mode == "r":
+        compression = get_compression(path)
+    if compression is None:
+        return io.open(path, mode, encoding="UTF-8")
+    if compression == "gzip":
+        return gzip.open(path, mode + "t", encoding="UTF-8",
+                         compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        zstandard = _zstandard()
+        f = open(path, mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f)
+        return io.TextIOWrapper(stream, encoding="UTF-8")
+    raise ValueError("unknown compression %r" % compression)
+
+
+def compress(data, compression=None):
+    """Compress bytes (as a whole) with the given compression."""
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError("unknown compression %r" % compression)
+
+
+def decompress(data):
+    """Decompress bytes made by compress, whatever the compression."""
+    if data.startswith(_GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(_ZSTD_MAGIC):
+        return _zstandard().ZstdDecompressor().decompress(data)
+    return data
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Read the processed corpus from Python.
+
+iter_books reads the text, tokens or counts of a list of books, e.g. the
+ids of a meta_query, and yields them one by one:
+
+    from src.metaquery import meta_query
+    from src.corpus import iter_books, ReadStats
+
+    mq = meta_query(path="metadata/metadata.parquet", filter_exist=False)
+    mq.filter_lang("en")
+    stats = ReadStats()
+    for PG_id, tokens in iter_books(mq.get_ids(), level="tokens", stats=stats):
+        ...
+    print(stats)
+
+Plain files are memory-mapped and decoded straight from the map. The next
+books are read and parsed on a background thread while the current one is
+being used, so the consumer does not wait for the disk unless it is faster
+than it.
+"""
+import mmap
+import os
+import queue
+import threading
+import time
+from os.path import join
+
+from .compression import open_compressed
+from .matrix import parse_counts
+from .packs import get_pack
+from .pipeline import get_output
+
+LEVELS = ("text", "tokens", "counts")
+# how many books are read ahead by default
+PREFETCH = 8
+
+
+class ReadStats(object):
+    """
+    How much was read, and how fast.
+
+    Attributes
+    ----------
+    books : int
+        Books read.
+    missing : int
+        Books asked for that are not in the level.
+    nbytes : int
+        Bytes read from disk (compressed, if the level is).
+    read_time : float
+        Seconds spent reading and parsing, in the background.
+    wait_time : float
+        Seconds the consumer spent waiting for the next book.
+    elapsed : float
+        Seconds from the first to the last book.
+    """
+
+    def __init__(self):
+        self.books = 0
+        self.missing = 0
+        self.nbytes = 0
+        self.read_time = 0.
+        self.wait_time = 0.
+        self.elapsed = 0.
+
+    def mb_per_s(self):
+        """Throughput as seen by the consumer, in MB/s."""
+        return self.nbytes / 2**20 / max(self.elapsed, 1e-9)
+
+    def __str__(self):
+        return ("Read %d books (%.1f MB, %d missing) in %.2f s: %.1f MB/s"
+                " (reading %.2f s, waiting %.2f s)" % (
+                    self.books, self.nbytes / 2**20, self.missing,
+                    self.elapsed, self.mb_per_s(), self.read_time,
+                    self.wait_time))
+
+
+def read_book(PG_id, level="text", level_dir=None, pack=False,
+              compression=None):
+    """
+    Read the content of a book at a level.
+
+    Parameters
+    ----------
+    PG_id : str
+        E.g. 'PG12345'.
+    level : str
+        'text', 'tokens' or 'counts'.
+    level_dir : str or None
+        Path to the folder of the level (data/<level>/ by default).
+    pack, compression
+        How the level was written (see pipeline.process_book).
+
+    Returns
+    -------
+    (str, int) or None
+        The content, and the bytes read from disk, or None if the book
+        is not in the level.
+    """
+    if level_dir is None:
+        level_dir = join("data", level)
+    if pack:
+        level_pack = get_pack(level_dir, level)
+        if PG_id not in level_pack:
+            return None
+        return level_pack.read_text(PG_id), level_pack.entries[PG_id][2]
+
+    path = get_output(level_dir, level, PG_id, compression=compression).path
+    try:
+        if compression is not None:
+            nbytes = os.path.getsize(path)
+            with open_compressed(path, compression=compression) as f:
+                return f.read(), nbytes
+        with open(path, "rb") as f:
+            nbytes = os.fstat(f.fileno()).st_size
+            if nbytes == 0:
+                # empty files cannot be mapped
+                return "", 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return str(mm, "UTF-8"), nbytes
+    except FileNotFoundError:
+        return None
+
+
+def parse_book(content, level="text"):
+    """
+    Parse the content of a book at a level.
+
+    Returns
+    -------
+    str, list of str or dict
+        The text, the list of tokens, or the counts (type to count).
+    """
+    if level == "tokens":
+        return [w for w in content.split("\n") if w]
+    if level == "counts":
+        types, counts = parse_counts(content)
+        return dict(zip(types, counts.tolist()))
+    return content
+
+
+def iter_books(ids, level="text", level_dir=None, pack=False,
+               compression=None, prefetch=PREFETCH, stats=None):
+    """
+    Read many books, prefetching the next ones on a background thread.
+
+    Books that are not in the level are skipped (and counted in stats).
+
+    Parameters
+    ----------
+    ids : iterable of str
+        PG ids, e.g. meta_query(...).get_ids().
+    level : str
+        'text', 'tokens' or 'counts' (see parse_book for what is yielded).
+    level_dir, pack, compression
+        See read_book.
+    prefetch : int
+        How many books may be read ahead of the consumer. With 0, books
+        are read in the calling thread when asked for.
+    stats : ReadStats or None
+        If given, it is updated as books are read.
+
+    Yields
+    ------
+    (str, str or list of str or dict)
+        The PG id and the parsed content of each book, in the order of
+        ids.
+    """
+    if level not in LEVELS:
+        raise ValueError("level must be one of %s, not %r" % (LEVELS, level))
+    if stats is None:
+        stats = ReadStats()
+
+    def read(PG_id):
+        t0 = time.perf_counter()
+        book = read_book(PG_id, level, level_dir, pack, compression)
+        if book is not None:
+            book = (parse_book(book[0], level), book[1])
+        stats.read_time += time.perf_counter() - t0
+        return book
+
+    t_start = time.perf_counter()
+    if prefetch <= 0:
+        books = ((PG_id, read(PG_id)) for PG_id in ids)
+    else:
+        books = _prefetch(((PG_id, read(PG_id)) for PG_id in ids), prefetch)
+    try:
+        while True:
+            t0 = time.perf_counter()
+            item = next(books, None)
+            stats.wait_time += time.perf_counter() - t0
+            stats.elapsed = time.perf_counter() - t_start
+            if item is None:
+                return
+            PG_id, book = item
+            if book is None:
+                stats.missing += 1
+                continue
+            stats.books += 1
+            stats.nbytes += book[1]
+            yield PG_id, book[0]
+    finally:
+        # stop the background thread if the consumer stops early
+        books.close()
+
+
+# put on the queue by the background thread after the last item
+_DONE = object()
+
+
+def _prefetch(items, size):
+    """
+    Consume an iterator on a background thread, up to size items ahead.
+
+    Exceptions raised by the iterator are raised again in the consumer.
+    If the consumer stops early, the thread stops too.
+    """
+    q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((None, e))
+            return
+        put((_DONE, None))
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Export the processed corpus to Parquet, joined with the metadata.
+
+Every book with a text and a tokens level becomes one row, with the fields
+of the metadata, its text, and the number of tokens and types (and, if
+asked for, the tokens themselves). Rows are partitioned by the first
+language of the book, in hive style:
+
+    out_dir/lang=en/part-00000.parquet
+    out_dir/lang=en/part-00001.parquet
+    out_dir/lang=fr/part-00000.parquet
+    ...
+
+Books are read one at a time and collected into record batches of bounded
+size, each written as a row group, so the memory used does not depend on
+the size of the corpus. Needs pyarrow (pip install pyarrow).
+"""
+import os
+from os.path import join
+
+import pandas as pd
+
+from .pipeline import get_output
+
+# bytes of rows (in Arrow) held in memory before a batch is written
+BATCH_BYTES = 64 * 2**20
+# rows of a parquet file before the next one of its partition is started
+FILE_ROWS = 20000
+
+
+def _pyarrow():
+    """Import pyarrow, which is only needed for the export."""
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The Parquet export needs the pyarrow package "
+                          "(pip install pyarrow)")
+    return pyarrow
+
+
+def get_schema(tokens=False):
+    """
+    Get the schema of the rows of the export.
+
+    Parameters
+    ----------
+    tokens : bool
+        Whether the rows have the list of tokens of the book.
+
+    Returns
+    -------
+    pyarrow.Schema
+    """
+    pa = _pyarrow()
+    fields = [
+        ("id", pa.string()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("authoryearofbirth", pa.int32()),
+        ("authoryearofdeath", pa.int32()),
+        ("language", pa.list_(pa.string())),
+        ("downloads", pa.int64()),
+        ("subjects", pa.list_(pa.string())),
+        ("type", pa.string()),
+        ("text", pa.string()),
+        ("n_tokens", pa.int64()),
+        ("n_types", pa.int64()),
+    ]
+    if tokens:
+        fields.append(("tokens", pa.list_(pa.string())))
+    return pa.schema(fields)
+
+
+def _optional(value, type_f):
+    """Convert a metadata value, or None if it is missing."""
+    if pd.isnull(value):
+        return None
+    return type_f(value)
+
+
+def iter_records(metadata, text_dir, tokens_dir, pack=False, compression=None,
+                 tokens=False):
+    """
+    Read the books in the metadata that have been processed, one by one.
+
+    Parameters
+    ----------
+    metadata : pd.DataFrame
+        The metadata, with the PG ids as index (as read by
+        metadata.read_metadata, with .set_index("id"))).
+    text_dir, tokens_dir : str
+        Paths to the text and tokens levels.
+    pack, compression
+        How the levels were written (see pipeline.process_book).
+    tokens : bool
+        Whether to include the list of tokens.
+
+    Yields
+    ------
+    (str, dict)
+        The partition of the book (its first language code) and its row.
+    """
+    for PG_id, book in metadata.iterrows():
+        text_out = get_output(text_dir, "text", PG_id, pack, compression)
+        tokens_out = get_output(tokens_dir, "tokens", PG_id, pack, compression)
+        if not (text_out.exists() and tokens_out.exists()):
+            continue
+        text = text_out.read()
+        tokens_text = tokens_out.read()
+        list_tokens = [w for w in tokens_text.split("\n") if w]
+        # in the order of the catalog: the first is the language of the book
+        language = list(book["language"] or [])
+        record = {
+            "id": PG_id,
+            "title": _optional(book["title"], str),
+            "author": _optional(book["author"], str),
+            "authoryearofbirth": _optional(book["authoryearofbirth"], int),
+            "authoryearofdeath": _optional(book["authoryearofdeath"], int),
+            "language": language,
+            "downloads": _optional(book["downloads"], int),
+            "subjects": sorted(book["subjects"] or []),
+            "type": _optional(book["type"], str),
+            "text": text,
+            "n_tokens": len(list_tokens),
+            "n_types": len(set(list_tokens)),
+        }
+        if tokens:
+            record["tokens"] = list_tokens
+        partition = language[0] if language else "unknown"
+        yield partition, record
+
+
+def export_parquet(out_dir, metadata, text_dir, tokens_dir, pack=False,
+                   compression=None, tokens=False, batch_bytes=BATCH_BYTES,
+                   file_rows=FILE_ROWS, parquet_compression="zstd"):
+    """
+    Write the processed books to partitioned Parquet files.
+
+    Every book is converted to Arrow as soon as it is read. The rows of
+    each partition are held in memory until all partitions together hold
+    more than batch_bytes; the largest is then written as a row group of
+    its current file.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the folder of the export. It must not exist or be empty.
+    metadata, text_dir, tokens_dir, pack, compression, tokens
+        See iter_records.
+    batch_bytes : int
+        Approximate maximum size (in bytes) of the rows held in memory.
+    file_rows : int
+        Number of rows after which a new file of the partition is started.
+    parquet_compression : str
+        Compression of the Parquet files, e.g. 'zstd' or 'snappy'.
+
+    Returns
+    -------
+    int
+        The number of books written.
+    """
+    pa = _pyarrow()
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise ValueError("The directory for the export '%s' is not empty"
+                         % out_dir)
+    schema = get_schema(tokens)
+
+    # rows not written yet (as record batches), and their size, by partition
+    buffers = {}
+    sizes = {}
+    # the writer, rows written to its file and number of files, by partition
+    writers = {}
+
+    def flush(partition):
+        writer, nrows, nfiles = writers.get(partition, (None, 0, 0))
+        if writer is not None and nrows >= file_rows:
+            writer.close()
+            writer = None
+        if writer is None:
+            os.makedirs(join(out_dir, "lang=%s" % partition), exist_ok=True)
+            writer = pa.parquet.ParquetWriter(
+                join(out_dir, "lang=%s" % partition, "part-%05d.parquet" % nfiles),
+                schema, compression=parquet_compression)
+            nrows = 0
+            nfiles += 1
+        table = pa.Table.from_batches(buffers.pop(partition), schema=schema)
+        sizes.pop(partition)
+        writer.write_table(table)
+        writers[partition] = (writer, nrows + table.num_rows, nfiles)
+
+    nbooks = 0
+    try:
+        for partition, record in iter_records(
+                metadata, text_dir, tokens_dir, pack=pack,
+                compression=compression, tokens=tokens):
+            batch = pa.RecordBatch.from_pylist([record], schema=schema)
+            buffers.setdefault(partition, []).append(batch)
+            sizes[partition] = sizes.get(partition, 0) + batch.nbytes
+            nbooks += 1
+            if sum(sizes.values()) > batch_bytes:
+                flush(max(sizes, key=sizes.get))
+        for partition in list(buffers):
+            flush(partition)
+    finally:
+        for writer, _, _ in writers.values():
+            writer.close()
+    return nbooks
+
+
+class ParquetBooks(object):
+    """
+    Read the books of a Parquet export lazily, e.g. for a dataloader.
+
+    Only one record batch is in memory at a time. The books can be
+    iterated over any number of times.
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder of the export.
+    columns : list of str or None
+        The columns to read (all by default). 'lang' is the partition.
+    filter : pyarrow.dataset.Expression or None
+        Only read the matching rows, e.g.
+        pyarrow.dataset.field("lang") == "en".
+    batch_size : int
+        Maximum number of rows read at a time.
+    shard : (int, int) or None
+        (i, n) to only read every n-th file starting from the i-th, e.g.
+        to split the books among the workers of a dataloader.
+    """
+
+    def __init__(self, path, columns=None, filter=None, batch_size=256,
+                 shard=None):
+        pa = _pyarrow()
+        self.dataset = pa.dataset.dataset(path, format="parquet",
+                                          partitioning="hive")
+        if shard is not None:
+            i, n = shard
+            files = sorted(self.dataset.files)[i::n]
+            self.dataset = pa.dataset.dataset(
+                files, format="parquet", partitioning=pa.dataset.partitioning(
+                    flavor="hive"), partition_base_dir=path)
+        self.columns = columns
+        self.filter = filter
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return self.dataset.count_rows(filter=self.filter)
+
+    def iter_batches(self):
+        """Read the books as pyarrow.RecordBatch, one at a time."""
+        return self.dataset.to_batches(
+            columns=self.columns, filter=self.filter,
+            batch_size=self.batch_size)
+
+    def __iter__(self):
+        """Read the books as dicts, one at a time."""
+        for batch in self.iter_batches():
+            for record in batch.to_pylist():
+                yield record
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Keep track of which books have been processed, and from what.
+
+The manifest is a SQLite database with one row per book, recording the
+size, modification time and content hash of the raw file together with
+the version of each processing stage used to produce the outputs, and the
+hashes of the text and tokens levels. The hash of the input of a stage
+plus its version tell whether the output of that stage is up to date.
+Only the process driving the run writes it, as books are completed; others
+may read it (see processed_books).
+"""
+import hashlib
+import os
+import sqlite3
+from os.path import join
+from urllib.request import pathname2url
+
+from .compression import SUFFIXES
+from .packs import Pack
+
+# columns of the books table, besides PG_id
+RAW_FIELDS = ("raw_size", "raw_mtime", "raw_hash")
+VERSION_FIELDS = ("cleanup_version", "tokenize_version", "counts_version",
+                  "ids_version")
+STAGE_FIELDS = ("text_hash", "tokens_hash")
+# levels written for every book in the manifest, and the optional ones
+# with the field that tells whether they were
+LEVELS = ("text", "tokens", "counts")
+OPTIONAL_LEVELS = {"ids": "ids_version"}
+
+
+def file_hash(path, blocksize=2**20):
+    """Get the sha1 hex digest of the contents of a file."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+
+def text_hash(text):
+    """Get the sha1 hex digest of a string, encoded as UTF-8."""
+    return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+
+class Manifest(object):
+    """
+    Persistent record of processed books, keyed by PG id.
+
+    The manifest is complete once a run has gone over the whole raw folder
+    (see set_complete): it then has a record of every processed book, and
+    processed_books can be used instead of listing the folders.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file. It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS books ("
+            "PG_id TEXT PRIMARY KEY, "
+            "raw_size INTEGER, raw_mtime REAL, raw_hash TEXT, "
+            "cleanup_version TEXT, tokenize_version TEXT, "
+            "counts_version TEXT, ids_version TEXT, "
+            "text_hash TEXT, tokens_hash TEXT)")
+        # add the columns missing in manifests written by older versions
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(books)")]
+        for field in VERSION_FIELDS + STAGE_FIELDS:
+            if field not in columns:
+                self.connection.execute(
+                    "ALTER TABLE books ADD COLUMN %s TEXT" % field)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, "
+            "value TEXT)")
+        self.connection.commit()
+        self.fields = ("PG_id",) + RAW_FIELDS + VERSION_FIELDS + STAGE_FIELDS
+
+    def records(self):
+        """
+        Get all records.
+
+        Returns
+        -------
+        dict
+            PG_id (e.g. 'PG12345') to a dict with the manifest fields.
+        """
+        cursor = self.connection.execute(
+            "SELECT %s FROM books" % ", ".join(self.fields))
+        return {row[0]: dict(zip(self.fields, row)) for row in cursor}
+
+    def update(self, record):
+        """Insert or replace the record of a book (not committed yet)."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO books (%s) VALUES (%s)" % (
+                ", ".join(self.fields), ", ".join("?" * len(self.fields))),
+            [record.get(field) for field in self.fields])
+
+    def remove(self, PG_id):
+        """Remove the record of a book (not committed yet)."""
+        self.connection.execute("DELETE FROM books WHERE PG_id = ?", (PG_id,))
+
+    def set_complete(self, complete=True):
+        """
+        Mark whether every processed book has a record (committed now).
+
+        A manifest is complete after a run over the whole raw folder has
+        recorded every book in it, including those processed before the
+        manifest existed. It stops being complete when books are processed
+        without it (e.g. with process_data.py --manifest '').
+        """
+        if complete:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) "
+                "VALUES ('complete', '1')")
+        else:
+            self.connection.execute(
+                "DELETE FROM state WHERE key = 'complete'")
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def processed_books(path, level="text"):
+    """
+    Get the books that have been processed up to a level.
+
+    A book is in the manifest once all its levels have been written (a book
+    that failed has no record), so this is read from the manifest instead
+    of listing the folders of the levels (see list_books), if the manifest
+    is complete (see Manifest.set_complete). The manifest is opened
+    read-only, and can be read while it is being written.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest.
+    level : str
+        One of LEVELS or OPTIONAL_LEVELS.
+
+    Returns
+    -------
+    set of str or None
+        The PG ids (e.g. 'PG12345'), or None if there is no manifest at
+        path, or if it is not complete (the folders must then be listed).
+    """
+    if level not in LEVELS and level not in OPTIONAL_LEVELS:
+        raise ValueError("Unknown level %r" % level)
+    if not os.path.isfile(path):
+        return None
+    connection = sqlite3.connect(
+        "file:%s?mode=ro" % pathname2url(os.path.abspath(path)), uri=True)
+    try:
+        try:
+            complete = connection.execute(
+                "SELECT value FROM state WHERE key = 'complete'").fetchone()
+        except sqlite3.OperationalError:
+            # written by an older version, without the state table
+            complete = None
+        if complete is None:
+            return None
+        query = "SELECT PG_id FROM books"
+        if level in OPTIONAL_LEVELS:
+            query += " WHERE %s IS NOT NULL" % OPTIONAL_LEVELS[level]
+        return {row[0] for row in connection.execute(query)}
+    finally:
+        connection.close()
+
+
+def list_books(level="text", level_dir=None):
+    """
+    List the books in a level, from the files in its folder.
+
+    This scans the whole folder, which can be slow on a network
+    filesystem; processed_books is much faster if there is a manifest.
+
+    Parameters
+    ----------
+    level : str
+        'raw', 'text', 'tokens', 'counts' or 'ids'.
+    level_dir : str or None
+        Path to the folder of the level (data/<level>/ by default).
+
+    Returns
+    -------
+    set of str
+        PG ids of the books with a file in the folder (compressed or not),
+        or in the shards of a pack in it.
+    """
+    if level_dir is None:
+        level_dir = join("data", level)
+    if level == "ids":
+        suffixes = ("_ids.npy",)
+    else:
+        suffixes = tuple("_%s.txt%s" % (level, suffix)
+                         for suffix in SUFFIXES.values())
+    ids = set()
+    try:
+        with os.scandir(level_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("PG") and \
+                        entry.name.endswith(suffixes):
+                    ids.add(entry.name.split("_")[0])
+    except FileNotFoundError:
+        return ids
+    if level in LEVELS:
+        ids.update(Pack(level_dir, level).ids())
+    return ids
+
+
+def is_unchanged(record, new_record, fields):
+    """
+    Check whether two records agree on all the given fields.
+
+    Fields that are None in new_record (e.g. the version of a stage that
+    is not run) are not compared.
+    """
+    return all(new_record[field] is None or record[field] == new_record[field]
+               for field in fields)
+
+
+def select_changed(filenames, records, versions, exists=None):
+    """
+    Select the raw files that may need to be processed.
+
+    A file is skipped only if its size and modification time are the ones
+    in its record, its outputs were made with the current versions of all
+    stages, and (if exists is given) its outputs are still there. This
+    only needs a stat of the raw file and of the outputs. Files that pass
+    may still turn out to be unchanged once their content is hashed.
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        Paths to raw files.
+    records : dict
+        As returned by Manifest.records.
+    versions : dict
+        The current version of each stage (see pipeline.stage_versions).
+    exists : function or None
+        Called with the PG id of a book, tells whether all its outputs
+        exist (see pipeline.outputs_exist).
+
+    Yields
+    ------
+    str
+        Paths to raw files that may need to be processed.
+    """
+    for filename in filenames:
+        PG_id = filename.split("/")[-1].split("_")[0]
+        record = records.get(PG_id)
+        if record is not None:
+            stat = os.stat(filename)
+            if record["raw_size"] == stat.st_size and \
+                    record["raw_mtime"] == stat.st_mtime and \
+                    is_unchanged(record, versions, VERSION_FIELDS) and \
+                    (exists is None or exists(PG_id)):
+                continue
+        yield filename
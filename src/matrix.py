@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Assemble the counts of all books into a single sparse matrix.
+
+The matrix has one row per book and one column per term of the vocabulary
+(see vocabulary.py), and is stored in CSR form as three flat binary files
+that can be memory-mapped, so loading the counts of the whole corpus does
+not need to open one file per book:
+
+    indptr.int64   row i holds the entries indptr[i] to indptr[i+1]
+    indices.int32  the column (term id) of every entry, sorted within rows
+    data.int32     the count of every entry
+    rows.txt       the PG id of every row, with the size and modification
+                   time (in ns) of the counts file it was read from (or
+                   the length and time written, if read from a pack)
+
+New books are appended as new rows. If the counts file of a book already
+in the matrix changed, its new counts are appended as well, and the new row
+supersedes the old one. A book whose counts were removed gets an empty row
+with size and time -1. load_matrix only returns the last row of every book
+that was not removed. Once the superseded rows hold more entries than the
+others, the matrix is built again on the next update.
+"""
+import glob
+import io
+import os
+from os.path import join
+
+import numpy as np
+
+from .compression import open_compressed
+from .packs import Pack
+from .vocabulary import Vocabulary
+
+INDPTR_FILE = "indptr.int64"
+INDICES_FILE = "indices.int32"
+DATA_FILE = "data.int32"
+ROWS_FILE = "rows.txt"
+
+
+def read_counts(path):
+    """
+    Read a counts file, possibly compressed (see compression.py).
+
+    Returns
+    -------
+    (list of str, np.ndarray of int32)
+        The types and their counts, in the order of the file.
+    """
+    with open_compressed(path) as f:
+        return parse_counts(f.read())
+
+
+def parse_counts(text):
+    """Parse the content of a counts file (see read_counts)."""
+    types = []
+    counts = []
+    for line in text.splitlines():
+        if line:
+            w, c = line.split("\t")
+            types.append(w)
+            counts.append(int(c))
+    return types, np.array(counts, dtype=np.int32)
+
+
+def read_rows(matrix_dir):
+    """
+    Read the rows of a matrix.
+
+    Returns
+    -------
+    list of (str, int, int)
+        The PG id of every row, with the size and modification time (in
+        ns) of its counts file.
+    """
+    path = join(matrix_dir, ROWS_FILE)
+    if not os.path.isfile(path):
+        return []
+    rows = []
+    with io.open(path, encoding="UTF-8") as f:
+        for line in f:
+            PG_id, size, mtime = line.rstrip("\n").split("\t")
+            rows.append((PG_id, int(size), int(mtime)))
+    return rows
+
+
+def live_rows(rows):
+    """
+    Get the rows of a matrix that are not superseded (see read_rows).
+
+    Returns
+    -------
+    dict
+        PG id to the position of its last row, for the books that were not
+        removed.
+    """
+    last = {}
+    for i, (PG_id, _, _) in enumerate(rows):
+        last[PG_id] = i
+    return {PG_id: i for PG_id, i in last.items() if rows[i][1] >= 0}
+
+
+def update_matrix(counts_dir, matrix_dir, vocabulary_file=None, pack=False):
+    """
+    Add the books in a counts folder that are new or changed to the matrix.
+
+    The terms get the ids of the vocabulary, to which the terms it does
+    not know yet are added. Books are added in order of PG number, after
+    the books removed from the counts folder. The rows of a book are only
+    written once its entries are, so a matrix left behind by an
+    interrupted update is still valid.
+
+    Parameters
+    ----------
+    counts_dir : str
+        Path to the counts folder.
+    matrix_dir : str
+        Path to the folder of the matrix. It must exist.
+    vocabulary_file : str or None
+        Path to the vocabulary file (see vocabulary.Vocabulary). It must
+        be the one used for the rows already in the matrix.
+    pack : bool
+        Whether the counts are in a pack (see packs.Pack).
+
+    Returns
+    -------
+    int
+        The number of books added, changed or removed (all of them if the
+        matrix was built again).
+    """
+    if pack:
+        counts_pack = Pack(counts_dir, "counts")
+        # the length and time written of every book
+        stamps = {PG_id: (length, written) for PG_id, (_, _, length, written)
+                  in counts_pack.entries.items()}
+        read = lambda PG_id: parse_counts(counts_pack.read_text(PG_id))
+    else:
+        counts_files = {}
+        stamps = {}
+        # sorted, so that if a book has both a plain and a compressed
+        # file (e.g. after changing --compression), the newest is used
+        for path in sorted(glob.glob(join(counts_dir, "PG*_counts.txt*"))):
+            PG_id = path.split("/")[-1].split("_")[0]
+            stat = os.stat(path)
+            if PG_id in stamps and stamps[PG_id][1] > stat.st_mtime_ns:
+                continue
+            counts_files[PG_id] = path
+            stamps[PG_id] = (stat.st_size, stat.st_mtime_ns)
+        read = lambda PG_id: read_counts(counts_files[PG_id])
+
+    rows = read_rows(matrix_dir)
+    indptr = _truncate(matrix_dir, rows)
+    live = live_rows(rows)
+    by_number = lambda PG_id: int(PG_id[2:])
+    removed = sorted((PG_id for PG_id in live if PG_id not in stamps),
+                     key=by_number)
+    new_ids = sorted((PG_id for PG_id in stamps if PG_id not in live or
+                      tuple(rows[live[PG_id]][1:]) != stamps[PG_id]),
+                     key=by_number)
+
+    # entries of the rows that are superseded once the update is done
+    row_nnz = np.diff(indptr)
+    changed = set(new_ids)
+    kept = sum(int(row_nnz[i]) for PG_id, i in live.items()
+               if PG_id in stamps and PG_id not in changed)
+    if int(indptr[-1]) - kept > kept:
+        # most of the matrix is superseded: build it again
+        rows = []
+        indptr = _truncate(matrix_dir, rows)
+        removed = []
+        new_ids = sorted(stamps, key=by_number)
+    nnz = int(indptr[-1])
+
+    vocabulary = Vocabulary(vocabulary_file)
+    with open(join(matrix_dir, INDPTR_FILE), "ab") as f_indptr, \
+            open(join(matrix_dir, INDICES_FILE), "ab") as f_indices, \
+            open(join(matrix_dir, DATA_FILE), "ab") as f_data, \
+            io.open(join(matrix_dir, ROWS_FILE), "a", encoding="UTF-8") as f_rows:
+        for PG_id in removed:
+            f_indptr.write(np.array([nnz], dtype="<i8").tobytes())
+            f_indptr.flush()
+            f_rows.write("%s\t-1\t-1\n" % PG_id)
+            f_rows.flush()
+        for PG_id in new_ids:
+            size, mtime = stamps[PG_id]
+            types, counts = read(PG_id)
+            ids = vocabulary.ids(types).astype(np.int32)
+            order = np.argsort(ids)
+            nnz += len(ids)
+            f_indices.write(ids[order].astype("<i4").tobytes())
+            f_data.write(counts[order].astype("<i4").tobytes())
+            f_indptr.write(np.array([nnz], dtype="<i8").tobytes())
+            for f in (f_indices, f_data, f_indptr):
+                f.flush()
+            f_rows.write("%s\t%d\t%d\n" % (PG_id, size, mtime))
+            f_rows.flush()
+    vocabulary.close()
+    return len(removed) + len(new_ids)
+
+
+def _truncate(matrix_dir, rows):
+    """
+    Cut the files of a matrix to the given rows, or start them if empty.
+
+    Returns
+    -------
+    np.ndarray
+        The indptr of the rows left.
+    """
+    if not rows:
+        with open(join(matrix_dir, INDPTR_FILE), "wb") as f:
+            f.write(np.array([0], dtype="<i8").tobytes())
+        for name in (INDICES_FILE, DATA_FILE, ROWS_FILE):
+            open(join(matrix_dir, name), "wb").close()
+        return np.zeros(1, dtype=np.int64)
+    indptr = np.fromfile(join(matrix_dir, INDPTR_FILE), dtype="<i8",
+                         count=len(rows) + 1)
+    nnz = int(indptr[-1])
+    os.truncate(join(matrix_dir, INDPTR_FILE), 8 * (len(rows) + 1))
+    os.truncate(join(matrix_dir, INDICES_FILE), 4 * nnz)
+    os.truncate(join(matrix_dir, DATA_FILE), 4 * nnz)
+    return indptr
+
+
+def load_matrix(matrix_dir, vocabulary_file=None, mmap=True):
+    """
+    Load the matrix of counts.
+
+    Parameters
+    ----------
+    matrix_dir : str
+        Path to the folder of the matrix.
+    vocabulary_file : str or None
+        Path to the vocabulary file. It gives the number of columns, and
+        the terms of the columns. If None, the matrix has as many columns
+        as the largest term id in it requires, and no terms are returned.
+    mmap : bool
+        Memory-map the files instead of reading them.
+
+    Returns
+    -------
+    (scipy.sparse.csr_matrix, list of str, list of str or None)
+        The matrix (books x terms), the PG id of every row and the term
+        of every column. If some rows are superseded (see update_matrix),
+        the others are copied, so the matrix is not memory-mapped.
+    """
+    # scipy is only needed to load the matrix, not to build it
+    import scipy.sparse
+
+    rows = read_rows(matrix_dir)
+    PG_ids = [PG_id for PG_id, _, _ in rows]
+    if mmap:
+        # empty files can not be memory-mapped
+        load = lambda name, dtype, count: np.memmap(
+            join(matrix_dir, name), dtype=dtype, mode="r", shape=(count,)) \
+            if count else np.zeros(0, dtype=dtype)
+    else:
+        load = lambda name, dtype, count: np.fromfile(
+            join(matrix_dir, name), dtype=dtype, count=count)
+    indptr = load(INDPTR_FILE, "<i8", len(PG_ids) + 1)
+    nnz = int(indptr[-1])
+    indices = load(INDICES_FILE, "<i4", nnz)
+    data = load(DATA_FILE, "<i4", nnz)
+
+    terms = None
+    if vocabulary_file is not None:
+        terms = Vocabulary(vocabulary_file).terms
+        ncols = len(terms)
+    else:
+        ncols = int(indices.max()) + 1 if nnz else 0
+    matrix = scipy.sparse.csr_matrix(
+        (data, indices, indptr), shape=(len(PG_ids), ncols), copy=False)
+    live = sorted(live_rows(rows).values())
+    if len(live) < len(rows):
+        matrix = matrix[live]
+        PG_ids = [PG_ids[i] for i in live]
+    return matrix, PG_ids, terms
+
+
+def align_rows(matrix, PG_ids, ids):
+    """
+    Reorder the rows of a matrix, e.g. as the ids of the metadata.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+    PG_ids : list of str
+        The PG id of every row of the matrix.
+    ids : iterable of str
+        The PG ids of the rows wanted, e.g. metadata["id"]. Books that
+        are not in the matrix get an empty row.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    import scipy.sparse
+
+    row = {PG_id: i for i, PG_id in enumerate(PG_ids)}
+    # missing books point to an empty row added at the end
+    selection = [row.get(PG_id, len(PG_ids)) for PG_id in ids]
+    padded = scipy.sparse.vstack(
+        [matrix, scipy.sparse.csr_matrix((1, matrix.shape[1]),
+                                         dtype=matrix.dtype)], format="csr")
+    return padded[selection]
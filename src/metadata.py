@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Read and write the metadata of the books with proper types.
+
+metadata.csv stores the languages and subjects of every book as the repr of
+a Python list or set (e.g. "['en', 'fr']"), which has to be parsed again
+by every reader. The same table is also written to metadata.parquet, with
+
+    id                  int32, the number of the book (12345 for PG12345)
+    title, author       string
+    authoryearofbirth   int32, or null
+    authoryearofdeath   int32, or null
+    language            list of string (in the order of the catalog), or
+                        null
+    downloads           int64, or null
+    subjects            list of string (sorted)
+    type                dictionary (categorical) string
+    LCC                 list of string (sorted), the Library of Congress
+                        classes (not in metadata.csv)
+
+and read_metadata reads either file into the same typed DataFrame, only
+loading the columns asked for. Writing and reading the Parquet file needs
+pyarrow.
+"""
+import ast
+import os
+from os.path import join
+
+import pandas as pd
+
+METADATA_PARQUET = "metadata.parquet"
+METADATA_CSV = "metadata.csv"
+COLUMNS = ("id", "title", "author", "authoryearofbirth", "authoryearofdeath",
+           "language", "downloads", "subjects", "type", "LCC")
+
+
+def _pyarrow():
+    """Import pyarrow, which is needed for the Parquet metadata."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The Parquet metadata needs the pyarrow package "
+                          "(pip install pyarrow)")
+    return pyarrow
+
+
+def get_schema():
+    """Get the schema of metadata.parquet, as a pyarrow.Schema."""
+    pa = _pyarrow()
+    return pa.schema([
+        ("id", pa.int32()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("authoryearofbirth", pa.int32()),
+        ("authoryearofdeath", pa.int32()),
+        ("language", pa.list_(pa.string())),
+        ("downloads", pa.int64()),
+        ("subjects", pa.list_(pa.string())),
+        ("type", pa.dictionary(pa.int32(), pa.string())),
+        ("LCC", pa.list_(pa.string())),
+    ])
+
+
+def get_metadata_path(metadata_dir="metadata"):
+    """
+    Get the path to the metadata to read.
+
+    That is metadata.parquet in metadata_dir if it exists and pyarrow is
+    installed, and metadata.csv otherwise.
+    """
+    path = join(metadata_dir, METADATA_PARQUET)
+    if os.path.exists(path):
+        try:
+            _pyarrow()
+            return path
+        except ImportError:
+            pass
+    return join(metadata_dir, METADATA_CSV)
+
+
+def _literal(value):
+    """Parse a list or set written to metadata.csv, e.g. "['en']"."""
+    if not isinstance(value, str):
+        return None
+    if value == "set()":
+        return set()
+    return ast.literal_eval(value)
+
+
+def _int_or_none(value):
+    return None if pd.isnull(value) else int(value)
+
+
+def write_metadata(df, path):
+    """
+    Write the metadata to a Parquet file.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The metadata as built by metadataparser.make_df_metadata: one row
+        per book, with the PG ids (e.g. 'PG12345') as index, language a
+        list, subjects and LCC (if given) sets, and missing values as
+        None or NaN.
+    path : str
+        Path to the Parquet file.
+    """
+    pa = _pyarrow()
+    columns = {
+        "id": [int(PG_id[2:]) for PG_id in df.index],
+        "title": [None if pd.isnull(v) else str(v) for v in df["title"]],
+        "author": [None if pd.isnull(v) else str(v) for v in df["author"]],
+        "authoryearofbirth": [_int_or_none(v)
+                              for v in df["authoryearofbirth"]],
+        "authoryearofdeath": [_int_or_none(v)
+                              for v in df["authoryearofdeath"]],
+        "language": [list(v) if isinstance(v, (list, tuple)) else None
+                     for v in df["language"]],
+        "downloads": [_int_or_none(v) for v in df["downloads"]],
+        "subjects": [sorted(v) if isinstance(v, (set, list, tuple)) else []
+                     for v in df["subjects"]],
+        "type": [None if pd.isnull(v) else str(v) for v in df["type"]],
+        "LCC": [sorted(v) if isinstance(v, (set, list, tuple)) else []
+                for v in df.get("LCC", [None] * len(df))],
+    }
+    table = pa.Table.from_pydict(columns, schema=get_schema())
+    pa.parquet.write_table(table, path)
+
+
+def read_metadata(path, columns=None):
+    """
+    Read the metadata, from metadata.parquet or metadata.csv.
+
+    Parameters
+    ----------
+    path : str
+        Path to the Parquet or csv file (see get_metadata_path).
+    columns : list of str or None
+        The columns to read (all by default). 'id' is always read. Only
+        these are loaded from a Parquet file.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per book, with 'id' the PG id (e.g. 'PG12345'), the years
+        and downloads nullable integers, language and subjects lists (or
+        None if the languages are not known) and type categorical. LCC
+        is only in metadata.parquet.
+    """
+    if columns is not None:
+        columns = ["id"] + [c for c in columns if c != "id"]
+    if path.endswith(".parquet"):
+        pa = _pyarrow()
+        table = pa.parquet.read_table(path, columns=columns)
+        df = table.to_pandas(types_mapper={
+            pa.int32(): pd.Int64Dtype(), pa.int64(): pd.Int64Dtype()}.get)
+        df["id"] = ["PG%d" % PG_number for PG_number in df["id"]]
+        for column in ("language", "subjects", "LCC"):
+            if column in df:
+                df[column] = [None if v is None else list(v)
+                              for v in df[column]]
+        return df
+
+    df = pd.read_csv(path, usecols=columns)
+    for column in ("authoryearofbirth", "authoryearofdeath", "downloads"):
+        if column in df:
+            df[column] = df[column].astype(pd.Int64Dtype())
+    if "language" in df:
+        df["language"] = [_literal(v) for v in df["language"]]
+    if "subjects" in df:
+        df["subjects"] = [sorted(_literal(v) or ()) for v in df["subjects"]]
+    if "type" in df:
+        df["type"] = df["type"].astype("category")
+    return df
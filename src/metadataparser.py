@@ -5,12 +5,17 @@ Extract metadata from Project Gutenberg RDF catalog into a Python dict.
 Based on https://bitbucket.org/c-w/gutenberg/
 """
 
+import itertools
 import os
 import re
+import sqlite3
 import tarfile
+import time
 import urllib
 import urllib.request
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import xml.etree.cElementTree as ElementTree
 try:
@@ -18,6 +23,9 @@ try:
 except ImportError:
     import pickle
 
+from .changefeed import diff_records, write_changefeed
+from .metadata import write_metadata
+
 # The Python dict produced by this module
 # PICKLEFILE = '../data/metadata/md.pickle.gz'
 # The catalog downloaded from Gutenberg
@@ -38,11 +46,17 @@ ETEXTRE = re.compile(r'''
     |
     (?P<etextid_back>\d+)\s*\#)
     ''', re.IGNORECASE | re.VERBOSE)
+# fields that change with every update of the catalog, and do not make a
+# book modified in the changefeed
+VOLATILE_FIELDS = ('downloads',)
+# RDF files parsed per task of the pool of readmetadata
+PARSE_BATCH = 500
 
 
 def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
                      path_out='../metadata/metadata.csv',
-                     update=False):
+                     update=False, workers=1, path_store=None,
+                     path_changefeed=None, path_parquet=None):
     """
     Write metadata in a csv.
 
@@ -59,7 +73,26 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
     update : bool
         (False) Download the latest rdf-file even if it already
         exists in path_xml
+    workers : int
+        (1) Number of processes parsing the rdf-files.
+    path_store : str or None
+        (None) Location of the store of parsed records (see RecordStore).
+        If given, only the rdf-files that are new or changed since the
+        last run are parsed.
+    path_changefeed : str or None
+        (None) Where to append the ids of the books added, modified or
+        removed since the last run (see changefeed). Needs path_store.
+    path_parquet : str or None
+        (None) Where to save the metadata with proper types as well (see
+        metadata.write_metadata).
 
+    Returns
+    -------
+    dict
+        Seconds spent in each phase: 'download', 'decompress', 'parse'
+        (summed over the workers), 'dataframe', 'csv' and 'parquet' (if
+        written); and the number
+        of rdf-files 'parsed' and 'cached'.
 
     Notes
     -------
@@ -67,8 +100,25 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
 
 
     """
-    # parse the xml-file
-    md = readmetadata(path_xml, update=update)
+    if path_changefeed is not None and path_store is None:
+        raise ValueError("A changefeed needs a store of parsed records")
+    timings = {}
+    store = None
+    if path_store is not None:
+        store = RecordStore(path_store)
+    try:
+        old_md = store.metadata() if store is not None else None
+        # parse the xml-file
+        md = readmetadata(path_xml, update=update, workers=workers,
+                          timings=timings, store=store)
+    finally:
+        if store is not None:
+            store.close()
+    if path_changefeed is not None:
+        write_changefeed(path_changefeed, [
+            (status, 'PG%s' % PG_id)
+            for status, PG_id in diff_records(_stable(old_md), _stable(md))])
+    t0 = time.perf_counter()
     # convert into a pandas dataframe
     df = pd.DataFrame.from_dict(md).T
     # which fields to keep
@@ -76,19 +126,147 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
                       'authoryearofdeath', 'language', 'downloads',
                       'subjects', 'type'
                       ]
-    df = df[columns_select]
+    df = df[columns_select + ['LCC']]
     # change id from id-->PGid
     df['id'] = df['id'].apply(lambda x: 'PG%s' % (x))
     # id as index
     df = df.set_index('id')
-    df.to_csv(path_out)
-    return None
+    t1 = time.perf_counter()
+    df[columns_select[1:]].to_csv(path_out)
+    t2 = time.perf_counter()
+    timings['dataframe'] = t1 - t0
+    timings['csv'] = t2 - t1
+    if path_parquet is not None:
+        write_metadata(df, path_parquet)
+        timings['parquet'] = time.perf_counter() - t2
+    return timings
+
+
+def _stable(md):
+    """Drop the VOLATILE_FIELDS from the records of readmetadata."""
+    return {PG_id: {key: value for key, value in result.items()
+                    if key not in VOLATILE_FIELDS}
+            for PG_id, result in md.items()}
 
 
-def readmetadata(RDFFILES, update=False):
+class RecordStore(object):
+    """
+    Persistent store of the records parsed from the rdf-files.
+
+    A SQLite database with one row per file of the tar, keyed by its name,
+    with the modification time and size of the file in the tar, the PG id
+    of the ebook it defines and the parsed record (see parsemetadata),
+    pickled. Files that do not define an ebook are kept too, with no id
+    and no record, so that they are not parsed again either.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file. It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "member TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+            "PG_id INTEGER, record BLOB)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS members_PG_id ON members (PG_id)")
+        self.connection.commit()
+
+    def stamps(self):
+        """
+        Get the modification time and size of every stored file.
+
+        Returns
+        -------
+        dict
+            Name of the file in the tar to (mtime, size).
+        """
+        cursor = self.connection.execute(
+            "SELECT member, mtime, size FROM members")
+        return {member: (mtime, size) for member, mtime, size in cursor}
+
+    def records(self, members):
+        """
+        Get the stored records of some files.
+
+        Returns
+        -------
+        dict
+            Name of the file to its record, or None if it does not define
+            an ebook.
+        """
+        records = {}
+        cursor = self.connection.execute("SELECT member, record FROM members")
+        for member, record in cursor:
+            if member in members:
+                records[member] = None if record is None \
+                    else pickle.loads(record)
+        return records
+
+    def metadata(self):
+        """Get all stored records, as returned by readmetadata."""
+        cursor = self.connection.execute(
+            "SELECT record FROM members WHERE record IS NOT NULL "
+            "ORDER BY rowid")
+        metadata = {}
+        for record, in cursor:
+            result = pickle.loads(record)
+            metadata[result['id']] = result
+        return metadata
+
+    def update(self, member, mtime, size, result):
+        """Insert or replace the record of a file (not committed yet)."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO members (member, mtime, size, PG_id, "
+            "record) VALUES (?, ?, ?, ?, ?)",
+            (member, mtime, size,
+             None if result is None else result['id'],
+             None if result is None else pickle.dumps(result, protocol=-1)))
+
+    def remove(self, member):
+        """Remove the record of a file (not committed yet)."""
+        self.connection.execute(
+            "DELETE FROM members WHERE member = ?", (member,))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def readmetadata(RDFFILES, update=False, workers=1, timings=None,
+                 store=None):
     """
     Read/create cached metadata dump of Gutenberg catalog.
 
+    The tar of rdf-files is decompressed once, as a stream, and the
+    rdf-files are parsed in batches; with workers > 1 the batches are
+    parsed in a pool of processes while the next ones are decompressed.
+    The result is the same, and in the same order, as with one worker.
+
+    Parameters
+    ----------
+    RDFFILES : str
+        Location of the tar of rdf-files (see getrdfdata).
+    update : bool
+        Download the latest tar even if it exists.
+    workers : int
+        Number of processes parsing the rdf-files.
+    timings : dict or None
+        If given, the seconds spent downloading, decompressing and
+        parsing (summed over the workers) are stored in it, with the
+        number of rdf-files 'parsed' and taken from the store ('cached').
+    store : RecordStore or None
+        If given, the rdf-files whose modification time and size in the
+        tar are those in the store are not parsed again, and the store is
+        updated with the new, changed and removed files.
+
     Returns
     --------
     A dictionary with the following fields:
@@ -111,29 +289,75 @@ def readmetadata(RDFFILES, update=False):
     http://www.gutenberg.org/wiki/Gutenberg:Help_on_Bibliographic_Record_Page
 
     """
-    # if os.path.exists(PICKLEFILE):
-    #     metadata = pickle.load(gzip.open(PICKLEFILE, 'rb'))
-    # else:
+    if timings is None:
+        timings = {}
+    timings['parse'] = 0.
+    t0 = time.perf_counter()
+    downloadrdf(RDFFILES, update=update)
+    timings['download'] = time.perf_counter() - t0
+
+    stamps = store.stamps() if store is not None else {}
+    # (name, mtime, size) of the files of the tar, in order
+    members = []
+
+    def changed():
+        for member, mtime, size, payload in getrdfpayloads(
+                RDFFILES, timings=timings,
+                skip=lambda name, mtime, size:
+                stamps.get(name) == (mtime, size)):
+            members.append((member, mtime, size))
+            if payload is not None:
+                yield member, payload
+
+    payloads = changed()
+    batches = iter(lambda: list(itertools.islice(payloads, PARSE_BATCH)), [])
+    parsed = {}
+
+    def add(results, seconds):
+        timings['parse'] += seconds
+        parsed.update(results)
+
+    if workers <= 1:
+        for batch in batches:
+            add(*_parse_payloads(batch))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # a bounded number of batches in flight
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(_parse_payloads, batch))
+                if len(pending) >= 2 * workers:
+                    add(*pending.popleft().result())
+            while pending:
+                add(*pending.popleft().result())
+
+    cached = {}
+    if store is not None:
+        cached = store.records(
+            set(member for member, _, _ in members).difference(parsed))
+        for member, mtime, size in members:
+            if member in parsed:
+                store.update(member, mtime, size, parsed[member])
+        for member in set(stamps).difference(
+                member for member, _, _ in members):
+            store.remove(member)
+        store.commit()
+    timings['parsed'] = len(parsed)
+    timings['cached'] = len(cached)
+
+    # in the order of the tar, a later record of an id replacing an
+    # earlier one
     metadata = {}
-    for xml in getrdfdata(RDFFILES, update=update):
-        ebook = xml.find(r'{%(pg)s}ebook' % NS)
-        if ebook is None:
-            continue
-        result = parsemetadata(ebook)
+    for member, _, _ in members:
+        result = parsed[member] if member in parsed else cached[member]
         if result is not None:
             metadata[result['id']] = result
-        # pickle.dump(metadata, gzip.open(PICKLEFILE, 'wb'), protocol=-1)
     return metadata
 
 
-def getrdfdata(RDFFILES, update=False):
+def downloadrdf(RDFFILES, update=False):
     """
-    Download Project Gutenberg RDF catalog.
-
-    Yields
-    ------
-    xml.etree.ElementTree.Element
-        An etext meta-data definition.
+    Download Project Gutenberg RDF catalog, if it does not exist or update.
 
     """
     if (not os.path.exists(RDFFILES)) or (update is True):
@@ -146,12 +370,88 @@ def getrdfdata(RDFFILES, update=False):
             RDFURL = "http://gutenberg.readingroo.ms/cache/generated/feeds/rdf-files.tar.bz2"
             _, _ = urllib.request.urlretrieve(RDFURL, RDFFILES)
 
+
+def getrdfpayloads(RDFFILES, timings=None, skip=None):
+    """
+    Read the files of the RDF catalog, decompressing it once as a stream.
+
+    Parameters
+    ----------
+    RDFFILES : str
+        Location of the tar of rdf-files.
+    timings : dict or None
+        If given, the seconds spent decompressing are stored in it, under
+        'decompress'.
+    skip : callable or None
+        skip(name, mtime, size) tells whether the content of a file can
+        be skipped.
+
+    Yields
+    ------
+    (str, int, int, bytes or None)
+        The name, modification time, size and content (None if skipped)
+        of each file of the tar, in the order of the tar.
+
+    """
+    if timings is None:
+        timings = {}
+    timings['decompress'] = 0.
+    t0 = time.perf_counter()
+    # the members are read in order, so the compressed file is read (and
+    # decompressed) once, front to back; this is faster than mode 'r|*'
     with tarfile.open(RDFFILES) as archive:
         for tarinfo in archive:
-            try:
-                yield ElementTree.parse(archive.extractfile(tarinfo))
-            except:
-                pass
+            if not tarinfo.isfile():
+                continue
+            payload = None
+            if skip is None or not skip(tarinfo.name, tarinfo.mtime,
+                                        tarinfo.size):
+                payload = archive.extractfile(tarinfo).read()
+            timings['decompress'] += time.perf_counter() - t0
+            yield tarinfo.name, tarinfo.mtime, tarinfo.size, payload
+            t0 = time.perf_counter()
+        timings['decompress'] += time.perf_counter() - t0
+
+
+def getrdfdata(RDFFILES, update=False):
+    """
+    Download Project Gutenberg RDF catalog.
+
+    Yields
+    ------
+    xml.etree.ElementTree.Element
+        An etext meta-data definition.
+
+    """
+    downloadrdf(RDFFILES, update=update)
+    for _, _, _, payload in getrdfpayloads(RDFFILES):
+        try:
+            yield ElementTree.ElementTree(ElementTree.fromstring(payload))
+        except:
+            pass
+
+
+def _parse_payloads(payloads):
+    """
+    Parse a batch of rdf-files into meta-data dicts (see parsemetadata).
+
+    Returns a dict from the name of each file to its meta-data, or None if
+    it is not an ebook definition, and the seconds spent parsing.
+
+    """
+    t0 = time.perf_counter()
+    results = {}
+    for member, payload in payloads:
+        results[member] = None
+        try:
+            xml = ElementTree.fromstring(payload)
+        except:
+            continue
+        ebook = xml.find(r'{%(pg)s}ebook' % NS)
+        if ebook is None:
+            continue
+        results[member] = parsemetadata(ebook)
+    return results, time.perf_counter() - t0
 
 
 def parsemetadata(ebook):
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Inverted indexes over the metadata, for the filters of meta_query.
+
+For every language code, subject, LCC class, author and word of an author
+name, the index keeps the positions of the rows of the metadata that have
+it, so that a filter is a lookup instead of a scan of the whole column.
+Searching for a part of an author name only scans the distinct authors,
+lowercased once.
+
+The index is built the first time it is needed and cached next to the
+metadata file (metadata.parquet.index.pkl for metadata.parquet). The cache
+is used as long as the metadata file has the same size and modification
+time.
+"""
+import os
+import pickle
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .metadata import read_metadata
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.pkl"
+# columns of lists of items that are indexed
+LIST_COLUMNS = ("language", "subjects", "LCC")
+# words of author names
+TOKEN_RE = re.compile(r"\w+")
+# separates the authors in the string in which they are searched
+SEPARATOR = "\n"
+
+
+def _postings(positions, values):
+    """
+    Group row positions by value.
+
+    Returns
+    -------
+    dict
+        Value to the sorted array (int32) of the positions that have it.
+    """
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind="stable")
+    ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    positions = np.asarray(positions, dtype=np.int32)[order]
+    return {value: positions[end - count:end]
+            for value, end, count in zip(
+                uniques, ends, np.diff(ends, prepend=0))}
+
+
+class MetadataIndex(object):
+    """
+    Inverted indexes over the rows of the metadata.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The metadata, as read by metadata.read_metadata. Rows are referred
+        to by their position in it.
+
+    Attributes
+    ----------
+    nrows : int
+        Number of rows of the metadata.
+    postings : dict
+        For each column in LIST_COLUMNS (that is in df), and
+        'author_token': the positions of the rows (a sorted int32 array)
+        for each item, or lowercase word of an author name.
+    lengths : dict
+        For each column in LIST_COLUMNS, the number of items of each row.
+    authors_lower : list of str
+        The distinct authors, lowercased.
+    authors_joined : str
+        authors_lower joined with SEPARATOR, and authors_start where each
+        begins in it.
+    author_codes : np.ndarray
+        The author of each row, as a position in authors_lower (-1 if the
+        author is not known).
+    """
+
+    def __init__(self, df):
+        self.nrows = len(df)
+        self.postings = {}
+        self.lengths = {}
+        for column in LIST_COLUMNS:
+            if column not in df:
+                continue
+            values = df[column].reset_index(drop=True)
+            self.lengths[column] = np.array(
+                [0 if v is None else len(v) for v in values], dtype=np.int32)
+            items = values.explode().dropna()
+            self.postings[column] = _postings(items.index.values, items.values)
+
+        codes, authors = pd.factorize(df["author"])
+        self.author_codes = codes.astype(np.int32)
+        self.authors_lower = [author.lower() for author in authors]
+        self.authors_joined = SEPARATOR.join(self.authors_lower)
+        self.authors_start = np.cumsum(
+            [0] + [len(author) + 1 for author in self.authors_lower[:-1]])
+        known = np.flatnonzero(codes >= 0)
+        author_postings = _postings(known, codes[known])
+        tokens = {}
+        for code, author in enumerate(self.authors_lower):
+            for token in set(TOKEN_RE.findall(author)):
+                tokens.setdefault(token, []).append(author_postings[code])
+        self.postings["author_token"] = {
+            token: np.unique(np.concatenate(rows))
+            for token, rows in tokens.items()}
+
+    def rows(self, column, item, how="any"):
+        """
+        Get the rows with an item in a column of lists.
+
+        Parameters
+        ----------
+        column : str
+            One of LIST_COLUMNS.
+        item : str
+            E.g. 'en' for column 'language'.
+        how : str
+            'only' for the rows whose only item is item, 'any' for the
+            rows that have item and maybe others.
+
+        Returns
+        -------
+        np.ndarray
+            Sorted positions of the rows.
+        """
+        if column not in self.postings:
+            raise KeyError("The metadata has no column %r" % column)
+        rows = self.postings[column].get(item, np.empty(0, dtype=np.int32))
+        if how == "only":
+            return rows[self.lengths[column][rows] == 1]
+        if how == "any":
+            return rows
+        raise ValueError("how must be 'only' or 'any', not %r" % (how))
+
+    def author_rows(self, s, how="contains"):
+        """
+        Get the rows whose author matches s, ignoring case.
+
+        Parameters
+        ----------
+        s : str
+            Part of an author name, e.g. 'twain'.
+        how : str
+            'contains' for the authors that contain s, 'token' for the
+            authors that have all the words of s.
+
+        Returns
+        -------
+        np.ndarray
+            Sorted positions of the rows.
+        """
+        if how == "contains":
+            s = s.lower()
+            # one more False at the end, for the rows with code -1
+            match = np.zeros(len(self.authors_lower) + 1, dtype=bool)
+            if s and SEPARATOR not in s and self.authors_joined.count(s) < \
+                    len(self.authors_lower) // 16:
+                # few matches: find them all in one string
+                starts = []
+                start = self.authors_joined.find(s)
+                while start != -1:
+                    starts.append(start)
+                    start = self.authors_joined.find(s, start + 1)
+                match[np.searchsorted(self.authors_start, starts,
+                                      side="right") - 1] = True
+            else:
+                match[:-1] = [s in author for author in self.authors_lower]
+            return np.flatnonzero(match[self.author_codes]).astype(np.int32)
+        if how == "token":
+            tokens = TOKEN_RE.findall(s.lower())
+            if not tokens:
+                return np.empty(0, dtype=np.int32)
+            empty = np.empty(0, dtype=np.int32)
+            result = self.postings["author_token"].get(tokens[0], empty)
+            for token in tokens[1:]:
+                result = np.intersect1d(
+                    result, self.postings["author_token"].get(token, empty),
+                    assume_unique=True)
+            return result
+        raise ValueError("how must be 'contains' or 'token', not %r" % (how))
+
+
+def file_stamp(path):
+    """Identify a version of a metadata file: (INDEX_VERSION, size, mtime)."""
+    stat = os.stat(path)
+    return (INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def load_index(path, df=None):
+    """
+    Get the index of a metadata file, from its cache if it is up to date.
+
+    Otherwise the index is built and the cache written (if the folder of
+    the metadata is writable).
+
+    Parameters
+    ----------
+    path : str
+        Path to the metadata file.
+    df : pd.DataFrame or None
+        The metadata as read from path, if it has already been read.
+
+    Returns
+    -------
+    MetadataIndex
+    """
+    path_index = path + INDEX_SUFFIX
+    stamp = file_stamp(path)
+    try:
+        with open(path_index, "rb") as f:
+            cached_stamp, index = pickle.load(f)
+        if cached_stamp == stamp:
+            return index
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+
+    if df is None:
+        df = read_metadata(path)
+    index = MetadataIndex(df)
+    # write to a temporary file first, so that no one reads a partial index
+    try:
+        fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(path_index) or ".")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((stamp, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_tmp, path_index)
+    except OSError:
+        pass
+    return index
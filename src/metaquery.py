@@ -7,48 +7,173 @@ Query metadata. Get id's of books with given
 - date
 - ...
 
+Filters are not applied when they are called: they add to a plan (see
+queryplan), which is evaluated when the ids or the dataframe are asked for.
+Filters can also be combined with & (and), | (or) and ~ (not):
+
+    from src.queryplan import lang, subject
+    q.filter((lang('en') | lang('fr')) & ~subject('Poetry', how='any'))
+
 """
 
 import os 
-import pandas as pd
 import numpy as np
 from collections import Counter
-import re
-import glob
+
+from .manifest import list_books, processed_books
+from .metadata import get_metadata_path, read_metadata
+from .metaindex import load_index, file_stamp
+from . import queryplan
+from .queryplan import All, Rows, Top, evaluate, sorted_rows
+
+
+def _count_items(column):
+    '''count the items in a column of lists (or None)
+    '''
+    return Counter(column.explode().dropna())
+
 
 class meta_query(object):
 
-    def __init__(self, path='../metadata/metadata.csv', filter_exist=True):
-        '''filter_exist: Only keep entries in metadata for which we have the downloaded text.
+    def __init__(self, path=None, filter_exist=True, cache=queryplan.SHARED_CACHE, manifest=None):
+        '''path: metadata.parquet or metadata.csv (see metadata.read_metadata);
+        by default ../metadata/metadata.parquet, or metadata.csv if it does not exist.
+        filter_exist: Only keep entries in metadata for which we have the processed text.
+        cache: queryplan.PlanCache in which the results of the filters are kept,
+        by default the one shared by all queries of the process; None to not cache them.
+        manifest: manifest of the processed books (see manifest.Manifest), by default
+        data/manifest.sqlite next to the metadata folder; if it does not exist, is not complete
+        (see manifest.processed_books) or manifest='', the folders of the levels are listed instead.
         '''
-
-        self.df = pd.read_csv(path) ## the dataframe on which we apply filters
+        if path is None:
+            path = get_metadata_path(os.path.join('..', 'metadata'))
+        self.path = path
+        self.cache = cache
+        self.data_dir = os.path.abspath(os.path.join(path,os.pardir,os.pardir,'data'))
+        if manifest is None:
+            manifest = os.path.join(self.data_dir, 'manifest.sqlite')
+        self.manifest = manifest
+
+        self.df_all = read_metadata(path) ## all books, the rows of the index
+        self.nrows = len(self.df_all)
+        self.stamp = (os.path.abspath(path),) + file_stamp(path) ## identifies the metadata in the cache
+        self._index = None
+        self.base = All() ## the plan without filters
         if filter_exist == True: ## filter the books for which we have the data
-            path_text = os.path.abspath(os.path.join(path,os.pardir,os.pardir,'data','text'))
-            list_files = []
-            for file in list(glob.glob( path_text+'/PG*_text.txt' )):
-                list_files += [file]
-            list_ids = sorted([ h.split('/')[-1].split('_text')[0] for h in list_files ])
-            df = self.df
-            df_new = df[df['id'].isin(list_ids)]
-            self.df = df_new
-        self.df_original = self.df ## keep the original dataframe
+            self.base = self._level_rows('text')
+        self.reset()
+
+    def get_level_ids(self, level='text'):
+        '''return the set of PG-ids of the books at a level of processing:
+        'raw' (downloaded), 'text', 'tokens', 'counts' or 'ids'
+        '''
+        if level != 'raw' and self.manifest != '':
+            ids = processed_books(self.manifest, level)
+            if ids is not None:
+                return ids
+        ## no complete manifest: list the folder of the level
+        return list_books(level, os.path.join(self.data_dir, level))
+
+    def _level_rows(self, level):
+        ids = self.get_level_ids(level)
+        return Rows(np.fromiter((PG_id in ids for PG_id in self.df_all['id'].tolist()), dtype=bool, count=self.nrows), level)
+
+    def filter_level(self, level):
+        '''keep the books at a level of processing (see get_level_ids),
+        e.g. 'counts', or 'raw' for all the books that have been downloaded
+        '''
+        self.filter(self._level_rows(level))
 
     def reset(self):
-        '''reset df to original dataframe (remove all filters)
+        '''reset the plan to the original one (remove all filters)
+        '''
+        self.plan = self.base
+        self.sort_plan = None ## the plan sorted by downloads, if filter_downloads was called
+        self.order = None ## the order of a dataframe assigned to df
+
+    def filter(self, plan):
+        '''keep the books selected by a plan, e.g. queryplan.lang('en') | queryplan.lang('fr')
         '''
-        self.df = self.df_original
+        self.plan = self.plan & plan
+
+    def get_rows(self):
+        '''evaluate the plan: positions of the selected books in df_all, in order
+        '''
+        mask = evaluate(self.plan, self, self.cache)
+        if self.sort_plan is not None:
+            ## the order of the last filter_downloads, which later filters keep
+            order = sorted_rows(self.df_all, evaluate(self.sort_plan, self, self.cache), 'downloads')
+        elif self.order is not None:
+            ## the order of the dataframe assigned to df
+            order = self.order
+        else:
+            return np.flatnonzero(mask)
+        return order[mask[order]]
 
     def get_ids(self):
         '''return list of PG-ids of filtered dataframe
         '''
-        list_book_ids = self.df['id']
-        return list(list_book_ids)
+        return self.df_all['id'].values[self.get_rows()].tolist()
 
     def get_df(self):
         '''return the filtered dataframe
         '''
-        return self.df
+        return self.df_all.iloc[self.get_rows()]
+
+    @property
+    def df(self):
+        '''the filtered dataframe (see get_df)
+        '''
+        return self.get_df()
+
+    @df.setter
+    def df(self, df):
+        '''replace the filtered dataframe, e.g. q.df = q.df[q.df['downloads'] > 100]:
+        the plan becomes the books of df (by id), which later filters keep in the order of df
+        '''
+        position = dict(zip(self.df_all['id'].tolist(), range(self.nrows)))
+        try:
+            order = np.array([position[PG_id] for PG_id in df['id'].tolist()], dtype=np.int64)
+        except KeyError as e:
+            raise ValueError('%s is not in the metadata' % e.args[0])
+        mask = np.zeros(self.nrows, dtype=bool)
+        mask[order] = True
+        self.plan = Rows(mask, 'df')
+        self.sort_plan = None
+        self.order = order
+
+    @property
+    def df_original(self):
+        '''the dataframe without filters
+        '''
+        return self.df_all[evaluate(self.base, self, self.cache)]
+
+    @property
+    def index(self):
+        '''inverted indexes of the metadata (see metaindex), built or loaded
+        from the cache next to the metadata file on first use
+        '''
+        if self._index is None:
+            self._index = load_index(self.path, self.df_all)
+        return self._index
+
+    def evaluate_term(self, key):
+        '''bitset of the books selected by a queryplan.Term
+        '''
+        mask = np.zeros(self.nrows, dtype=bool)
+        column = key[0]
+        if column in ('language', 'subjects', 'LCC'):
+            mask[self.index.rows(column, key[1], how=key[2])] = True
+        elif column == 'author':
+            mask[self.index.author_rows(key[1], how=key[2])] = True
+        elif column == 'year':
+            y_sel, hmin = key[1], key[2]
+            y0, y1 = y_sel if isinstance(y_sel, tuple) else (y_sel, y_sel)
+            s = (self.df_all['authoryearofbirth'] <= y1 - hmin)&(self.df_all['authoryearofdeath']>y0)
+            mask = s.fillna(False).to_numpy(dtype=bool)
+        else:
+            raise ValueError('Unknown filter %r' % (key,))
+        return mask
 
     def filter_lang(self,lang_sel,how='only'):
         """
@@ -62,48 +187,34 @@ class meta_query(object):
             'only' to select books that only contain lang_sel
             'any' to select books that contain lang_sel and maybe other langs
         """
-        if how == 'only':
-            s = self.df[self.df['language'] == "['%s']"%(lang_sel)]
-        elif how =='any':
-            s = self.df[self.df['language'].str.contains("'%s'"%(lang_sel)).replace(np.nan,False)]
-        else:
-            s = meta
-        self.df = s
+        self.filter(queryplan.lang(lang_sel, how=how))
 
     ### LANGUAGE
     def get_lang(self):
-        list_lang = [[k for k in h.strip("[]")[1:-1].replace("', '","_").split('_')] for h in self.df['language'].dropna()]
-        list_lang_flat = [item for sublist in list_lang for item in sublist]
-        list_lang_set = sorted(list(set(list_lang_flat)))
-        return list_lang_set
+        return sorted(_count_items(self.df['language']))
 
     def get_lang_counts(self):
-        list_lang = [[k for k in h.strip("[]")[1:-1].replace("', '","_").split('_')] for h in self.df['language'].dropna()]
-        list_lang_flat = [item for sublist in list_lang for item in sublist]
-        return Counter(list_lang_flat)
+        return _count_items(self.df['language'])
     ### SUBJECTS
     def get_subjects(self):
-        list_subjects = [[k for k in h.strip("{}")[1:-1].replace("', '","_").split('_')] for h in self.df['subjects'].replace('set()',np.nan).dropna()]
-        list_subjects_flat = [item for sublist in list_subjects for item in sublist]
-        list_subjects_set = sorted(list(set(list_subjects_flat)))
-        return list_subjects_set
+        return sorted(_count_items(self.df['subjects']))
 
     def get_subjects_counts(self):
-        list_subjects = [[k for k in h.strip("{}")[1:-1].replace("', '","_").split('_')] for h in self.df['subjects'].replace('set()',np.nan).dropna()]
-        list_subjects_flat = [item for sublist in list_subjects for item in sublist]
-        return Counter(list_subjects_flat)
+        return _count_items(self.df['subjects'])
 
     def filter_subject(self,subject_sel,how='only'):
         ## filter metadata for subjects
         ## how == 'only', books that only contain subject
         ## how == 'any', all books that contain subject (and potentially others too)
-        if how == 'only':
-            s = self.df[self.df['subjects'] == "{'%s'}"%(subject_sel)]
-        elif how =='any':
-            s = self.df[self.df['subjects'].str.contains("'%s'"%(re.escape(subject_sel))).replace(np.nan,False)]
-        else:
-            s = meta
-        self.df = s
+        self.filter(queryplan.subject(subject_sel, how=how))
+
+    ### LCC
+    def filter_LCC(self,LCC_sel,how='any'):
+        ## filter metadata for Library of Congress classes, e.g. 'PS'
+        ## (only in metadata.parquet)
+        ## how == 'only', books that only have that class
+        ## how == 'any', all books that have that class (and potentially others too)
+        self.filter(queryplan.LCC(LCC_sel, how=how))
 
     ### TIME
     def filter_year(self,y_sel,hmin=20):
@@ -116,25 +227,23 @@ class meta_query(object):
         - 847 books with only authoryearofdeath
         - 13996 books missing both
         '''
-        if isinstance(y_sel,(list,np.ndarray)):
-            s = self.df[ (self.df['authoryearofbirth'] <= y_sel[1] - hmin)&(self.df['authoryearofdeath']>y_sel[0])]
-        else:
-            s = self.df[ (self.df['authoryearofbirth'] <= y_sel - hmin)&(self.df['authoryearofdeath']>y_sel)]
-        self.df = s
+        self.filter(queryplan.year(y_sel, hmin=hmin))
 
     ### AUTHOR
-    def filter_author(self,s_sel):
-        s = self.df[ self.df['author'].str.contains(re.escape(s_sel),case=False).replace(np.nan,False)] 
-        self.df = s
+    def filter_author(self,s_sel,how='contains'):
+        ## filter metadata for authors, ignoring case
+        ## how == 'contains', authors that contain s_sel, e.g. 'twain, m'
+        ## how == 'token', authors with all the words in s_sel, e.g. 'mark twain'
+        self.filter(queryplan.author(s_sel, how=how))
 
     ### Sort by the n most downloaded
     def filter_downloads(self,n=-1):
         ### keep only the n most downloaded
         ### if n = -1, keep all
-        s = self.df.sort_values('downloads',ascending=False)
+        self.sort_plan = self.plan
+        self.order = None
         if n>0:
-            s=s.iloc[:n]
-        self.df = s
+            self.plan = Top(self.plan, 'downloads', n)
 
 
 
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Index the books in the mirror of Project Gutenberg, and link them into raw.
+
+rsync puts the UTF-8 text of a book in the mirror (data/.mirror/) as
+12345-0.txt in a folder of its own (1/2/3/4/12345/), and for some books
+also as cache/epub/12345/pg12345.txt.utf8. scan_mirror lists the whole
+mirror in a single pass and chooses one file per book, the 12345-0.txt
+one if there are both. The result is the mirror index,
+
+    PG_id <tab> path in the mirror <tab> size <tab> mtime (ns) <tab> inode
+
+which is kept in a tab-separated file (data/mirror_index.tsv by default) for
+the next steps and runs. populate_raw then hard-links the file of every
+book into raw (as PG12345_raw.txt), unless it is already linked there, and
+diff_mirror_index tells which books were added, updated or removed since
+the previous index, for the changefeed (see changefeed.py).
+"""
+import os
+import re
+import tempfile
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os.path import join
+
+from .changefeed import diff_records
+
+# the names of the files of books, and which is chosen if a book has both
+FILE_PATTERNS = (re.compile(r"([1-9][0-9]*)-0\.txt"),
+                 re.compile(r"pg([0-9]+)\.txt\.utf8"))
+
+# how many folders a thread lists before the rest is shared again
+SCAN_BATCH = 64
+
+MirrorEntry = namedtuple("MirrorEntry", ["path", "size", "mtime", "inode"])
+
+
+def _scan_dir(path, relative):
+    """
+    List a folder of the mirror.
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder.
+    relative : str
+        Path to the folder relative to the mirror, ending with '/' (or ''
+        for the mirror).
+
+    Returns
+    -------
+    (list of (str, str), list of tuple)
+        (path, relative path) of the subfolders, and (number, pattern,
+        relative path, size, mtime, inode) of the files of books in the
+        folder, with pattern the position in FILE_PATTERNS.
+    """
+    subdirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, relative + entry.name + "/"))
+                continue
+            for i, pattern in enumerate(FILE_PATTERNS):
+                match = pattern.fullmatch(entry.name)
+                if match is not None:
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((match.group(1), i, relative + entry.name,
+                                  stat.st_size, stat.st_mtime_ns,
+                                  stat.st_ino))
+                    break
+    return subdirs, files
+
+
+def _scan_dirs(pending, max_dirs=None):
+    """
+    List folders of the mirror and their subfolders, depth-first.
+
+    Parameters
+    ----------
+    pending : list of (str, str)
+        (path, relative path) of the folders to list.
+    max_dirs : int or None
+        Stop after listing this many folders (None for no limit).
+
+    Returns
+    -------
+    (list of (str, str), list of tuple)
+        The folders left to list, and the files of books found (see
+        _scan_dir).
+    """
+    files = []
+    n_dirs = 0
+    while pending and (max_dirs is None or n_dirs < max_dirs):
+        subdirs, found = _scan_dir(*pending.pop())
+        pending.extend(subdirs)
+        files.extend(found)
+        n_dirs += 1
+    return pending, files
+
+
+def scan_mirror(mirror_dir, workers=1):
+    """
+    Index the books in the mirror.
+
+    Parameters
+    ----------
+    mirror_dir : str
+        Path to the mirror.
+    workers : int
+        Number of threads listing folders at the same time, which helps
+        on network filesystems. With workers <= 1 everything runs in the
+        current thread.
+
+    Returns
+    -------
+    (dict, list of str)
+        The index, PG id (e.g. 'PG12345') to the MirrorEntry of the file
+        chosen for the book (with its path relative to mirror_dir), and
+        the paths (relative to mirror_dir) to the other files of books that
+        have more than one, which are not used.
+    """
+    if workers <= 1:
+        _, found = _scan_dirs([(mirror_dir, "")])
+    else:
+        # every thread lists SCAN_BATCH folders, and the folders it did
+        # not get to are split between threads again, so that the large
+        # subtrees (e.g. cache/) are shared
+        found = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {executor.submit(
+                _scan_dirs, [(mirror_dir, "")], SCAN_BATCH)}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending, files = future.result()
+                    found.extend(files)
+                    size = max(1, min(SCAN_BATCH,
+                                      -(-len(pending) // workers)))
+                    running.update(
+                        executor.submit(_scan_dirs, pending[i:i + size],
+                                        SCAN_BATCH)
+                        for i in range(0, len(pending), size))
+
+    index = {}
+    duplicates = []
+    # books by number, and for each the file of the first pattern, then
+    # the first path
+    found.sort(key=lambda f: (int(f[0]), f[0], f[1], f[2]))
+    for number, _, path, size, mtime, inode in found:
+        PG_id = "PG%s" % number
+        if PG_id in index:
+            duplicates.append(path)
+            continue
+        index[PG_id] = MirrorEntry(path, size, mtime, inode)
+    return index, duplicates
+
+
+def populate_raw(mirror_dir, raw_dir, index, overwrite=False):
+    """
+    Hard-link the books of the mirror into raw, as PG12345_raw.txt.
+
+    A book already in raw is linked again if its file in raw is not the
+    one in the mirror, e.g. because rsync replaced it with a new version.
+    Books in raw that are not in the mirror are kept.
+
+    Parameters
+    ----------
+    mirror_dir : str
+        Path to the mirror.
+    raw_dir : str
+        Path to the raw folder.
+    index : dict
+        The mirror index (see scan_mirror).
+    overwrite : bool
+        Link all books again, even those already linked.
+
+    Returns
+    -------
+    dict
+        Number of books 'linked' (new in raw), 'relinked', 'unchanged' and
+        'failed' (e.g. because raw is not on the same filesystem as the
+        mirror).
+    """
+    with os.scandir(raw_dir) as entries:
+        raw_inodes = {entry.name: entry.inode() for entry in entries}
+    stats = dict(linked=0, relinked=0, unchanged=0, failed=0)
+    for PG_id, entry in index.items():
+        name = "%s_raw.txt" % PG_id
+        source = join(mirror_dir, entry.path)
+        target = join(raw_dir, name)
+        inode = raw_inodes.get(name)
+        try:
+            if inode is None:
+                os.link(source, target)
+                stats["linked"] += 1
+            elif overwrite or inode != entry.inode:
+                # link to a temporary name first, so that the book is
+                # never missing from raw
+                path_tmp = "%s.%d.tmp" % (target, os.getpid())
+                os.link(source, path_tmp)
+                os.replace(path_tmp, target)
+                stats["relinked"] += 1
+            else:
+                stats["unchanged"] += 1
+        except OSError:
+            stats["failed"] += 1
+    return stats
+
+
+def diff_mirror_index(old, new):
+    """
+    Compare two mirror indexes.
+
+    A book is modified if the path, size or modification time of its file
+    changed (not only its inode, e.g. if the mirror was copied).
+
+    Parameters
+    ----------
+    old, new : dict
+        Mirror indexes (see scan_mirror).
+
+    Returns
+    -------
+    list of (str, str)
+        (status, PG_id) of the books added, modified or removed (see
+        changefeed.diff_records).
+    """
+    def files(index):
+        return {PG_id: entry[:3] for PG_id, entry in index.items()}
+    return diff_records(files(old), files(new))
+
+
+def read_mirror_index(path):
+    """
+    Read a mirror index written by write_mirror_index.
+
+    Returns
+    -------
+    dict
+        PG id to MirrorEntry, empty if there is no index at path.
+    """
+    index = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 5:
+                continue
+            PG_id, path_book, size, mtime, inode = fields
+            index[PG_id] = MirrorEntry(
+                path_book, int(size), int(mtime), int(inode))
+    return index
+
+
+def write_mirror_index(path, index):
+    """Write a mirror index, replacing the previous one at once."""
+    fd, path_tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="UTF-8") as f:
+        for PG_id, entry in index.items():
+            f.write("%s\t%s\t%d\t%d\t%d\n" % ((PG_id,) + tuple(entry)))
+    os.replace(path_tmp, path)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Store a level of the corpus (text, tokens or counts) in a few large files.
+
+Instead of one file per book, the books of a level are appended to shard
+files in the folder of the level, e.g. text-0000.pack, text-0001.pack, ...
+Every shard has an index next to it (text-0000.idx) with one line per book
+written to it:
+
+    PG_id <tab> offset <tab> length <tab> time written (ns)
+
+A book is the UTF-8 content its file would have, possibly compressed (see
+compression.py); compressed books are decompressed when read, whatever the
+compression of the pack they are read with. A book written again
+(e.g. after its raw file changed) is appended again, and the entry written
+last is the one that counts. The index line of a book is only written once
+the book is in the shard, so a shard left behind by an interrupted run is
+still valid.
+
+Every process writing to a level holds a lock on the shard it appends to,
+so several workers can write the same level at the same time, each to its
+own shard. A shard is not appended to once it is larger than the maximum
+size, and a new one is started.
+"""
+import fcntl
+import glob
+import io
+import os
+import time
+from os.path import join
+
+from .compression import compress, decompress
+
+# start a new shard once the current one is larger than this (in bytes)
+SHARD_SIZE = 2**30
+
+
+class Pack(object):
+    """
+    A level of the corpus stored as shards in a folder.
+
+    The index of all shards is read when the pack is opened; books written
+    by other processes after that are only seen after reload.
+
+    Parameters
+    ----------
+    pack_dir : str
+        Path to the folder of the shards. It must exist.
+    level : str
+        Name of the level, e.g. 'text'. It is the prefix of the shards.
+    max_shard_size : int
+        Size (in bytes) above which a shard is not appended to.
+    compression : str or None
+        Compression of the books written (None, 'gzip' or 'zstd').
+    """
+
+    def __init__(self, pack_dir, level, max_shard_size=SHARD_SIZE,
+                 compression=None):
+        self.pack_dir = pack_dir
+        self.level = level
+        self.max_shard_size = max_shard_size
+        self.compression = compression
+        self._shard = None
+        self._data = None
+        self._index = None
+        self.reload()
+
+    def reload(self):
+        """Read the index of all shards again."""
+        entries = {}
+        for shard in self.shards():
+            for PG_id, offset, length, written in _read_index(
+                    join(self.pack_dir, shard + ".idx")):
+                if PG_id not in entries or entries[PG_id][3] <= written:
+                    entries[PG_id] = (shard, offset, length, written)
+        self.entries = entries
+
+    def shards(self):
+        """Get the names of the shards of the level, e.g. 'text-0000'."""
+        return sorted(
+            path.split("/")[-1][:-len(".pack")] for path in
+            glob.glob(join(self.pack_dir, "%s-*.pack" % self.level)))
+
+    def __contains__(self, PG_id):
+        return PG_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def ids(self):
+        """Get the PG ids of all books in the pack."""
+        return list(self.entries)
+
+    def read(self, PG_id):
+        """
+        Read a single book.
+
+        Parameters
+        ----------
+        PG_id : str
+            E.g. 'PG12345'.
+
+        Returns
+        -------
+        bytes
+            The content of the book, decompressed.
+
+        Raises
+        ------
+        KeyError
+            If the book is not in the pack.
+        """
+        shard, offset, length, _ = self.entries[PG_id]
+        with open(join(self.pack_dir, shard + ".pack"), "rb") as f:
+            f.seek(offset)
+            return decompress(f.read(length))
+
+    def read_text(self, PG_id):
+        """Read a single book, decoded as UTF-8."""
+        return self.read(PG_id).decode("UTF-8")
+
+    def iter_shard(self, shard):
+        """
+        Read the books of a shard sequentially.
+
+        Books that were written again later, in this shard or another, are
+        left out.
+
+        Yields
+        ------
+        (str, bytes)
+            The PG id and the content of each book, in the order they
+            were written.
+        """
+        entries = sorted(
+            (offset, length, PG_id)
+            for PG_id, (s, offset, length, _) in self.entries.items()
+            if s == shard)
+        with open(join(self.pack_dir, shard + ".pack"), "rb") as f:
+            for offset, length, PG_id in entries:
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield PG_id, decompress(f.read(length))
+
+    def iter_books(self):
+        """Read all books, shard by shard (see iter_shard)."""
+        for shard in self.shards():
+            for item in self.iter_shard(shard):
+                yield item
+
+    def write(self, PG_id, content):
+        """
+        Append a book to the shard of this process.
+
+        Parameters
+        ----------
+        PG_id : str
+        content : str or bytes
+            Strings are encoded as UTF-8. It is compressed with the
+            compression of the pack.
+        """
+        if isinstance(content, str):
+            content = content.encode("UTF-8")
+        content = compress(content, self.compression)
+        if self._data is None or self._size > self.max_shard_size:
+            self._open_shard()
+        offset = self._size
+        self._data.write(content)
+        self._data.flush()
+        self._size += len(content)
+        written = time.time_ns()
+        self._index.write("%s\t%d\t%d\t%d\n" % (PG_id, offset, len(content), written))
+        self._index.flush()
+        self.entries[PG_id] = (self._shard, offset, len(content), written)
+
+    def _open_shard(self):
+        """Lock the first shard that is free and not full, or a new one."""
+        self.close()
+        shards = self.shards()
+        number = int(shards[-1].split("-")[-1]) + 1 if shards else 0
+        while True:
+            if shards:
+                shard = shards.pop(0)
+            else:
+                # another process may have started this shard since the
+                # folder was listed: then try the next number
+                shard = "%s-%04d" % (self.level, number)
+                number += 1
+            f = open(join(self.pack_dir, shard + ".pack"), "ab")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            size = os.fstat(f.fileno()).st_size
+            if size > self.max_shard_size:
+                f.close()
+                continue
+            self._shard = shard
+            self._data = f
+            self._size = size
+            self._index = io.open(join(self.pack_dir, shard + ".idx"), "a",
+                                  encoding="UTF-8")
+            return
+
+    def close(self):
+        """Release the shard this process writes to, if any."""
+        if self._data is not None:
+            self._index.close()
+            self._data.close()
+            self._shard = self._data = self._index = None
+
+
+def _read_index(path):
+    """Read the complete lines of the index of a shard."""
+    if not os.path.isfile(path):
+        return
+    with io.open(path, encoding="UTF-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # being written right now
+                break
+            PG_id, offset, length, written = line.split("\t")
+            yield PG_id, int(offset), int(length), int(written)
+
+
+## the packs opened by the current process, by folder and level
+_packs = {}
+
+
+def get_pack(pack_dir, level, compression=None):
+    """Get the pack of a level, opened once per process."""
+    key = (pack_dir, level, compression)
+    if key not in _packs:
+        _packs[key] = Pack(pack_dir, level, compression=compression)
+    return _packs[key]
+
+
+def close_packs():
+    """Release the shards of all packs opened by the current process."""
+    for pack in _packs.values():
+        pack.close()
+    _packs.clear()
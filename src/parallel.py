@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Run the processing pipeline over many books, optionally on a pool of
+worker processes.
+
+Each worker loads the metadata (and NLTK) once, when it starts, and then
+processes the books it is sent one at a time. Results are reported back
+to the parent process as FileResult tuples, so that the parent can keep
+track of counts and warnings exactly as in the serial loop, keep the
+manifest of processed books up to date, and report where the time went.
+"""
+import functools
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .cleanup import strip_headers
+from .manifest import file_hash, is_unchanged, select_changed, VERSION_FIELDS
+from .metadata import read_metadata
+from .packs import close_packs
+from .pipeline import outputs_exist, process_book, stage_versions
+from .scheduler import SizeScheduler, StreamScheduler, WatchScheduler
+from .tokenizer import get_context, tokenize_text
+from .utils import get_langs_dict
+from .vocabulary import Vocabulary, VocabularyManager
+
+# errors reported back to the parent process
+ERROR_ENCODING = "encoding"
+ERROR_METADATA = "metadata"
+ERROR_UNKNOWN = "unknown"
+
+# per-process state, filled in by init_worker
+_worker = {}
+
+# what process_file reports back for every book
+FileResult = namedtuple("FileResult", ["filename", "error", "record", "timings"])
+FileResult.__doc__ = """
+The result of processing a raw file.
+
+filename : str
+    Path to the raw file.
+error : str or None
+    The error that prevented processing it (one of ERROR_ENCODING,
+    ERROR_METADATA, ERROR_UNKNOWN), or None.
+record : dict or None
+    The new manifest record of the book, if changes are tracked.
+timings : dict
+    'pid' of the process that did the work, 'process' the seconds it
+    spent on the book, and 'warmup' the seconds init_worker took in that
+    process if this is the first book it reports (None otherwise).
+"""
+
+
+def init_worker(path_metadata="metadata/metadata.csv", track_changes=False,
+                refresh=frozenset(), **kwargs):
+    """
+    Load everything a worker needs to process books.
+
+    This is run once per process. The metadata and the languages dict are
+    kept in memory for the lifetime of the process (the metadata is loaded
+    again if its file changes, see load_metadata), and the punkt models of
+    all languages are loaded into the tokenizer context of the process, so
+    that no book pays for them. The time this takes is reported with the
+    first result of the process.
+
+    Parameters
+    ----------
+    path_metadata : str
+        Path to the metadata, metadata.parquet or metadata.csv (see
+        metadata.read_metadata).
+    track_changes : bool
+        Whether process_file should compute a manifest record of
+        every book (see manifest.Manifest).
+    refresh : set of str
+        PG ids of the books to process again even if their outputs are up
+        to date.
+    **kwargs
+        Keyword arguments passed to process_book for every book
+        (text_dir, tokens_dir, counts_dir, log_file, ...).
+    """
+    t0 = time.perf_counter()
+    context = get_context()
+    context.preload()
+    context.tokenize("", language="english")
+
+    _worker["track_changes"] = track_changes
+    _worker["refresh"] = refresh
+    _worker["versions"] = get_stage_versions(kwargs)
+
+    _worker["path_metadata"] = path_metadata
+    _worker.pop("metadata", None)
+    _worker.pop("metadata_stamp", None)
+    load_metadata()
+    _worker["langs_dict"] = get_langs_dict()
+    _worker["kwargs"] = kwargs
+    _worker["warmup"] = time.perf_counter() - t0
+
+
+def load_metadata():
+    """
+    Load the metadata of the worker, unless its file is unchanged.
+
+    This is checked before every book, so that books added to the metadata
+    while the workers run (e.g. by get_data.py, in watch mode) are found.
+    If the file can not be read, e.g. because it is being written, the
+    metadata loaded before is kept, and the file is read again next time.
+    """
+    path_metadata = _worker["path_metadata"]
+    try:
+        stat = os.stat(path_metadata)
+    except OSError:
+        if "metadata" in _worker:
+            return
+        raise
+    # the file is checked before it is read, so that changes made while
+    # it is read are seen next time
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if stamp == _worker.get("metadata_stamp"):
+        return
+    try:
+        metadata = read_metadata(
+            path_metadata, columns=["language"]).set_index("id")
+    except Exception:
+        if "metadata" in _worker:
+            return
+        raise
+    _worker["metadata"] = metadata
+    _worker["metadata_stamp"] = stamp
+
+
+def get_stage_versions(kwargs):
+    """Get the stage versions used by process_book with these kwargs."""
+    return stage_versions(
+        cleanup_f=kwargs.get("cleanup_f", strip_headers),
+        tokenize_f=kwargs.get("tokenize_f", tokenize_text),
+        cleanup_file_f=kwargs.get("cleanup_file_f"),
+        ids=kwargs.get("ids_dir") is not None)
+
+
+def get_PG_id(filename):
+    """Get the PG id (e.g. 'PG12345') from the path to a raw file."""
+    return filename.split("/")[-1].split("_")[0]
+
+
+def get_language(PG_id, metadata, langs_dict):
+    """
+    Get the language used to tokenize a book.
+
+    The language is the first language code of the book in the metadata,
+    or english if that code is not in langs_dict.
+
+    Raises
+    ------
+    KeyError
+        If there is no metadata for PG_id.
+    """
+    # language is a list of languages codes
+    lang_id = metadata.loc[PG_id, "language"][0]
+    return langs_dict.get(lang_id, "english")
+
+
+def process_file(filename, record=None):
+    """
+    Process a single raw file in the current worker, timing it.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the raw file.
+    record : dict or None
+        The manifest record of the book, or None if it has none.
+
+    Returns
+    -------
+    FileResult
+    """
+    t0 = time.perf_counter()
+    error, new_record = _process_file(filename, record)
+    timings = {
+        "pid": os.getpid(),
+        "process": time.perf_counter() - t0,
+        "warmup": _worker.pop("warmup", None),
+    }
+    return FileResult(filename, error, new_record, timings)
+
+
+def _process_file(filename, record=None):
+    """
+    Process a single raw file in the current worker.
+
+    When changes are tracked, the raw file is hashed first. If the hash and
+    the stage versions match the book's previous record, its outputs are up
+    to date and nothing is done. If they do not match, the book is processed
+    again, recomputing only the stages whose input or version changed.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the raw file.
+    record : dict or None
+        The manifest record of the book, or None if it has none.
+
+    Returns
+    -------
+    (str or None, dict or None)
+        The error that prevented processing the file (one of
+        ERROR_ENCODING, ERROR_METADATA, ERROR_UNKNOWN, or None), and the
+        new manifest record of the book if changes are tracked.
+    """
+    new_record = None
+    # The process_books function will fail very rarely, when
+    # a file tagged as UTF-8 is not really UTF-8. We just
+    # skip those books.
+    try:
+        # get PG_id
+        PG_id = get_PG_id(filename)
+
+        # get language from metadata
+        load_metadata()
+        language = get_language(
+            PG_id, _worker["metadata"], _worker["langs_dict"])
+
+        kwargs = _worker["kwargs"]
+        if PG_id in _worker["refresh"]:
+            kwargs = dict(kwargs, overwrite_all=True)
+        if _worker["track_changes"]:
+            stat = os.stat(filename)
+            new_record = dict(
+                PG_id=PG_id,
+                raw_size=stat.st_size,
+                raw_mtime=stat.st_mtime,
+                raw_hash=file_hash(filename),
+                **_worker["versions"])
+            # the record is only trusted if the outputs are still there
+            if record is not None and \
+                    is_unchanged(record, new_record,
+                                 ("raw_hash",) + VERSION_FIELDS) and \
+                    outputs_exist(PG_id, **kwargs):
+                return None, dict(record, **new_record)
+            if record is not None:
+                kwargs = dict(kwargs, previous=record,
+                              raw_hash=new_record["raw_hash"])
+
+        # process the book: strip headers, tokenize, count
+        stages = process_book(
+            path_to_raw_file=filename,
+            language=language,
+            **kwargs
+        )
+        if new_record is not None and stages is not None:
+            new_record.update(stages)
+    except UnicodeDecodeError:
+        return ERROR_ENCODING, None
+    except KeyError:
+        return ERROR_METADATA, None
+    except Exception:
+        return ERROR_UNKNOWN, None
+    return None, new_record
+
+
+def process_files(filenames, workers=1,
+                  path_metadata="metadata/metadata.csv",
+                  largest_first=None, memory_budget=None, manifest=None,
+                  vocabulary_file=None, refresh=None, watcher=None,
+                  poll_interval=10., **kwargs):
+    """
+    Process many raw files, yielding results as books are completed.
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        Paths to raw files. Unless the files are scheduled by size,
+        it is consumed lazily, so it can be a generator such as glob.iglob.
+    workers : int
+        Number of worker processes. With workers <= 1 everything
+        runs in the current process.
+    path_metadata : str
+        Path to the metadata (see init_worker).
+    largest_first : bool or None
+        Process the largest files first (see SizeScheduler). By default
+        this is done whenever there is more than one worker.
+    memory_budget : int or None
+        Maximum memory (in bytes) that the books being processed at the
+        same time may need, as estimated by SizeScheduler. None means no
+        limit. Implies largest_first.
+    manifest : manifest.Manifest or None
+        If given, only books whose raw file or stage versions changed
+        since they were recorded in the manifest are processed (unless
+        overwrite_all is passed), and the manifest is updated as books
+        are completed.
+    vocabulary_file : str or None
+        Path to the vocabulary file, used if ids_dir is passed (see
+        vocabulary.Vocabulary). With several workers, the vocabulary is
+        served to all of them from a manager process.
+    refresh : iterable of str or None
+        PG ids (e.g. 'PG12345') of books to process again from scratch,
+        even if their outputs are up to date, e.g. because their metadata
+        changed.
+    watcher : watch.RawWatcher or None
+        If given, files are not taken from filenames but from
+        watcher.poll(), every poll_interval seconds, as they become ready
+        (see scheduler.WatchScheduler), until it returns None. Files are
+        then processed in the order they are found, and the manifest is
+        committed at least every poll_interval seconds. The files that
+        fail are passed to watcher.failed, so that they can be returned
+        again (see watch.RawWatcher.failed).
+    poll_interval : float
+        Seconds between two polls of watcher.
+    **kwargs
+        Keyword arguments passed to process_book for every book.
+
+    Yields
+    ------
+    FileResult
+        See process_file. Results come in order of completion.
+    """
+    refresh = frozenset(refresh or ())
+    records = {}
+    if manifest is not None and not kwargs.get("overwrite_all", False):
+        records = manifest.records()
+        for PG_id in refresh:
+            records.pop(PG_id, None)
+        versions = get_stage_versions(kwargs)
+        exists = functools.partial(_outputs_exist, kwargs)
+        filenames = select_changed(filenames, records, versions, exists)
+        if watcher is not None:
+            watcher = _SelectChanged(watcher, records, versions, exists)
+    worker_kwargs = dict(kwargs, track_changes=manifest is not None,
+                         refresh=refresh)
+
+    vocabulary = manager = None
+    if kwargs.get("ids_dir") is not None and "vocabulary" not in kwargs:
+        if workers <= 1:
+            vocabulary = Vocabulary(vocabulary_file)
+        else:
+            manager = VocabularyManager()
+            manager.start()
+            vocabulary = manager.Vocabulary(vocabulary_file)
+        worker_kwargs["vocabulary"] = vocabulary
+
+    if largest_first is None:
+        largest_first = workers > 1
+    if watcher is not None:
+        scheduler = WatchScheduler(watcher.poll, poll_interval=poll_interval)
+    elif largest_first or memory_budget is not None:
+        scheduler = SizeScheduler(filenames, memory_budget=memory_budget)
+    else:
+        scheduler = StreamScheduler(filenames)
+
+    if workers <= 1:
+        init_worker(path_metadata, **worker_kwargs)
+        results = (
+            process_file(filename, records.get(get_PG_id(filename)))
+            for filename in iter(
+                functools.partial(scheduler.next, block=True), None))
+    else:
+        results = _process_files_in_pool(
+            scheduler, records, workers, path_metadata, worker_kwargs)
+
+    try:
+        last_commit = time.time()
+        for i, result in enumerate(results):
+            scheduler.done(result.filename)
+            if watcher is not None and result.error is not None:
+                watcher.failed(result.filename)
+            if manifest is not None and result.record is not None:
+                manifest.update(result.record)
+                # a book may be sent again while watching
+                records[result.record["PG_id"]] = result.record
+                if i % 1000 == 0 or (
+                        scheduler.poll_interval is not None and
+                        time.time() - last_commit > scheduler.poll_interval):
+                    manifest.commit()
+                    last_commit = time.time()
+            yield result
+    finally:
+        if manifest is not None:
+            manifest.commit()
+        # release the shards written by this process, if any
+        close_packs()
+        if vocabulary is not None:
+            vocabulary.close()
+        if manager is not None:
+            manager.shutdown()
+
+
+def _outputs_exist(kwargs, PG_id):
+    """Check the outputs of a book, with the kwargs of process_files."""
+    return outputs_exist(PG_id, **kwargs)
+
+
+class _SelectChanged(object):
+    """A watcher that only returns the files select_changed selects."""
+
+    def __init__(self, watcher, records, versions, exists=None):
+        self.watcher = watcher
+        self.records = records
+        self.versions = versions
+        self.exists = exists
+
+    def poll(self):
+        filenames = self.watcher.poll()
+        if filenames is None:
+            return None
+        return list(select_changed(
+            filenames, self.records, self.versions, self.exists))
+
+    def failed(self, filename):
+        self.watcher.failed(filename)
+
+
+def _process_files_in_pool(scheduler, records, workers, path_metadata,
+                           worker_kwargs):
+    """Yield the results of process_file, run on a pool of processes."""
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=functools.partial(
+                init_worker, path_metadata, **worker_kwargs)) as executor:
+        # keep a bounded number of books in flight; the scheduler may
+        # also hold books back until others are done
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:
+                # wait for a file only if there is nothing else to wait for
+                filename = scheduler.next(block=not pending)
+                if filename is None:
+                    break
+                pending.add(executor.submit(
+                    process_file, filename, records.get(get_PG_id(filename))))
+            if not pending:
+                break
+            # look for new files from time to time, even if no book is done
+            done, pending = wait(pending, timeout=scheduler.poll_interval,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
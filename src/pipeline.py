@@ -1,10 +1,54 @@
 # -*- coding: utf-8 -*-
 from .cleanup import strip_headers
 from .tokenizer import tokenize_text
+from .compression import SUFFIXES, open_compressed
+from .manifest import text_hash
+from .packs import get_pack
+from .vocabulary import encode_tokens, count_ids
 from collections import Counter
+import hashlib
 import io
 import os
 
+import numpy as np
+
+# bump whenever a change to the counting stage changes its output
+COUNTS_VERSION = 1
+# bump whenever a change to the ids stage changes its output
+IDS_VERSION = 1
+
+
+def get_version(f):
+    """
+    Identify a stage function and its version, e.g. 'strip_headers:1'.
+
+    Stage functions declare their version in a 'version' attribute.
+    """
+    return "%s:%s" % (f.__name__, getattr(f, "version", 0))
+
+
+def stage_versions(cleanup_f=strip_headers, tokenize_f=tokenize_text,
+                   cleanup_file_f=None, ids=False):
+    """
+    Get the version of each processing stage.
+
+    The arguments are those given to process_book, and whether the ids
+    level is written.
+
+    Returns
+    -------
+    dict
+        With keys 'cleanup_version', 'tokenize_version', 'counts_version'
+        and 'ids_version' (None if the ids level is not written).
+    """
+    return {
+        "cleanup_version": get_version(cleanup_file_f or cleanup_f),
+        "tokenize_version": get_version(tokenize_f),
+        "counts_version": "counts:%s" % COUNTS_VERSION,
+        "ids_version": "ids:%s" % IDS_VERSION if ids else None,
+    }
+
+
 def process_book(
 	path_to_raw_file=None,
 	text_dir=None,
@@ -14,7 +58,14 @@ def process_book(
 	cleanup_f=strip_headers,
     overwrite_all=False,
     language="english",
-    log_file=""
+    log_file="",
+    previous=None,
+    raw_hash=None,
+    cleanup_file_f=None,
+    ids_dir=None,
+    vocabulary=None,
+    pack=False,
+    compression=None
 	):
     """
     Process a book, from raw data to counts.
@@ -25,6 +76,8 @@ def process_book(
     2. text: the book with headers/legal notices/etc removed.
     3. tokens: the tokenized book. One token per line.
     4. counts: the counts of all types. One type per line.
+    5. ids (optional): the id of every token in a corpus-wide vocabulary,
+       as a .npy array of uint32 (see vocabulary.py).
 
     This function takes a file at the 'raw' level and computes the counts,
     saving to disk the intermediate 'text' and 'tokens' files.
@@ -35,10 +88,44 @@ def process_book(
     files already exist (raw,text,tokens and counts). The overwrite_all
     keyword can cahnge this behaviour.
 
+    If the record of a previous run is given instead, each level is only
+    recomputed if its input or the version of its stage changed, e.g. the
+    tokens are kept if a new version of cleanup_f gives the same text.
+
     Parameters
     ----------
     overwrite_all : bool
         If set to True, everything is processed regargless of existing files.
+    previous : dict or None
+        The manifest record of the previous run (see manifest.Manifest).
+    raw_hash : str or None
+        Hash of the raw file, to compare with the one in previous.
+    cleanup_file_f : function or None
+        If given, used instead of cleanup_f to write the text file straight
+        from the raw file, e.g. cleanup.strip_headers_file. The raw file is
+        then not read into memory (the lines for the log are counted as it
+        is read in chunks), and the text file is only read back if it has
+        to be tokenized.
+    ids_dir : str or None
+        If given, the ids level is written to this folder, and the counts
+        are computed from the ids.
+    vocabulary : vocabulary.Vocabulary or None
+        The vocabulary giving the ids (or a proxy to it, see
+        vocabulary.VocabularyManager). Required with ids_dir.
+    pack : bool
+        If set to True, the text, tokens and counts levels are appended
+        to the shards in text_dir, tokens_dir and counts_dir instead of
+        written to a file per book (see packs.Pack).
+    compression : str or None
+        Compress the text, tokens and counts levels: None, 'gzip' or
+        'zstd' (see compression.py). Files get the suffix of the
+        compression, e.g. PG12345_text.txt.gz.
+
+    Returns
+    -------
+    dict or None
+        The versions of the stages and the hashes of the text and tokens
+        levels, or None if the book was skipped.
     """
     if text_dir is None:
         raise ValueError("You must specify a path to save the text files.")
@@ -51,48 +138,253 @@ def process_book(
         
     if path_to_raw_file is None:
         raise ValueError("You must specify a path to the raw file to process.")
+
+    if ids_dir is not None and vocabulary is None:
+        raise ValueError("You must specify a vocabulary to save the ids files.")
    
     # get PG number
     PG_number = path_to_raw_file.split("/")[-1].split("_")[0][2:]
 
-    if overwrite_all or\
-        (not os.path.isfile(os.path.join(text_dir,"PG%s_text.txt"%PG_number))) or \
-        (not os.path.isfile(os.path.join(tokens_dir,"PG%s_tokens.txt"%PG_number))) or \
-        (not os.path.isfile(os.path.join(counts_dir,"PG%s_counts.txt"%PG_number))):
-        # read raw file
+    PG_id = "PG%s"%PG_number
+    text_out = get_output(text_dir, "text", PG_id, pack, compression)
+    tokens_out = get_output(tokens_dir, "tokens", PG_id, pack, compression)
+    counts_out = get_output(counts_dir, "counts", PG_id, pack, compression)
+    ids_out = None
+    if ids_dir is not None:
+        ids_out = FileOutput(os.path.join(ids_dir,"PG%s_ids.npy"%PG_number))
+
+    if overwrite_all:
+        previous = None
+    elif previous is None and \
+        text_out.exists() and \
+        tokens_out.exists() and \
+        counts_out.exists() and \
+        (ids_out is None or ids_out.exists()):
+        return None
+
+    record = stage_versions(cleanup_f=cleanup_f, tokenize_f=tokenize_f,
+                            cleanup_file_f=cleanup_file_f,
+                            ids=ids_out is not None)
+    text_cached = is_cached(
+        previous, text_out,
+        raw_hash=raw_hash, cleanup_version=record["cleanup_version"])
+
+    # read raw file, unless it is cleaned up from file to file
+    text = None
+    if not text_cached and cleanup_file_f is None:
         with io.open(path_to_raw_file, encoding="UTF-8") as f:
             text = f.read()
+    raw_nl = None
+    if log_file != "":
+        if text is not None:
+            raw_nl = text.count("\n")
+        else:
+            raw_nl = count_lines(path_to_raw_file)
 
-        # clean it up
+    # clean it up, unless the text file was made from the same raw file.
+    # clean stays None if the text is in its file, which is then only read
+    # if it has to be tokenized
+    clean = None
+    if text_cached:
+        pass
+    elif cleanup_file_f is not None:
+        # write a temporary file first, so that a book that fails part-way
+        # (e.g. not UTF-8) does not leave a partial text file behind
+        path = os.path.join(
+            text_dir, "%s_text.txt.%d.tmp" % (PG_id, os.getpid()))
+        try:
+            cleanup_file_f(path_to_raw_file, path)
+            if text_out.path is not None and text_out.compression is None:
+                os.replace(path, text_out.path)
+            else:
+                # a plain text file, to be compressed or packed
+                clean = FileOutput(path).read()
+                text_out.write(clean)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    else:
         clean = cleanup_f(text)
+        text = None
 
         # write text file
-        target_file = os.path.join(text_dir,"PG%s_text.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write(clean)
+        text_out.write(clean)
+    if clean is None:
+        record["text_hash"], clean_nl = scan_text(text_out)
+    else:
+        record["text_hash"] = text_hash(clean)
+        clean_nl = clean.count("\n")
 
-        # compute tokens
+    # compute tokens, unless the tokens file was made from the same text
+    if is_cached(previous, tokens_out,
+                 text_hash=record["text_hash"],
+                 tokenize_version=record["tokenize_version"]):
+        tokens_text = tokens_out.read()
+        tokens = [w for w in tokens_text.split("\n") if w]
+    else:
+        if clean is None:
+            clean = text_out.read()
         tokens = tokenize_f(clean, language=language)
-   
+        tokens_text = "\n".join(tokens)+"\n"
+
         # write tokens file
-        target_file = os.path.join(tokens_dir,"PG%s_tokens.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write("\n".join(tokens)+"\n")
+        tokens_out.write(tokens_text)
+    record["tokens_hash"] = text_hash(tokens_text)
+
+    # compute ids, unless the ids file was made from the same tokens
+    types = None
+    if ids_out is not None and \
+        not is_cached(previous, ids_out,
+                      tokens_hash=record["tokens_hash"],
+                      ids_version=record["ids_version"]):
+        # one call to the vocabulary per book, with the distinct tokens
+        types, local_ids = encode_tokens(tokens)
+        np.save(ids_out.path, vocabulary.ids(types)[local_ids])
 
-        # compute counts
-        counts = Counter(tokens)
+    # compute counts, unless the counts file was made from the same tokens
+    counts = None
+    if not is_cached(previous, counts_out,
+                     tokens_hash=record["tokens_hash"],
+                     counts_version=record["counts_version"]):
+        if types is not None:
+            counts = count_ids(types, local_ids)
+        else:
+            counts = Counter(tokens).most_common()
         
         # write counts file
-        target_file = os.path.join(counts_dir,"PG%s_counts.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write("\n".join([w+"\t"+str(c) for w,c in counts.most_common()])+"\n")
+        counts_out.write("\n".join([w+"\t"+str(c) for w,c in counts])+"\n")
 
-        # write log info if log_file is not None
-        if log_file != "":
-            raw_nl = text.count("\n")
-            clean_nl = clean.count("\n")
-            L = len(tokens)
-            V = len(counts)
-            with io.open(log_file, "a") as f:
-               f.write("PG"+str(PG_number)+"\t"+language+"\t"+str(raw_nl)+"\t"+str(clean_nl)+"\t"+str(L)+"\t"+str(V)+"\n")
-                
+    # write log info if log_file is not None
+    if log_file != "":
+        L = len(tokens)
+        V = len(counts) if counts is not None else len(set(tokens))
+        with io.open(log_file, "a") as f:
+           f.write("PG"+str(PG_number)+"\t"+language+"\t"+str(raw_nl)+"\t"+str(clean_nl)+"\t"+str(L)+"\t"+str(V)+"\n")
+    return record
+
+
+def count_lines(path, chunk_size=2**20):
+    """
+    Count the line breaks of a UTF-8 file, as text.count("\\n") of the
+    whole file read as text would, reading it in chunks.
+    """
+    n = 0
+    # universal newlines, as when the whole file is read
+    with io.open(path, encoding="UTF-8") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            n += chunk.count("\n")
+    return n
+
+
+def scan_text(output, chunk_size=2**20):
+    """
+    Get the hash (see manifest.text_hash) and the number of line breaks of
+    the content of an output, reading it in chunks if it has a file.
+    """
+    if output.path is None:
+        content = output.read()
+        return text_hash(content), content.count("\n")
+    digest = hashlib.sha1()
+    n = 0
+    with open_compressed(output.path, compression=output.compression) as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            digest.update(chunk.encode("UTF-8"))
+            n += chunk.count("\n")
+    return digest.hexdigest(), n
+
+
+def outputs_exist(PG_id, text_dir=None, tokens_dir=None, counts_dir=None,
+                  ids_dir=None, pack=False, compression=None, **kwargs):
+    """
+    Check whether all the outputs of a book exist.
+
+    The arguments are those given to process_book (others are ignored).
+    This is one stat per level, or a lookup in the index of the pack.
+    """
+    outputs = [get_output(level_dir, level, PG_id, pack, compression)
+               for level_dir, level in ((text_dir, "text"),
+                                        (tokens_dir, "tokens"),
+                                        (counts_dir, "counts"))]
+    if ids_dir is not None:
+        outputs.append(
+            FileOutput(os.path.join(ids_dir, "%s_ids.npy" % PG_id)))
+    return all(output.exists() for output in outputs)
+
+
+def is_cached(previous, output, **inputs):
+    """
+    Check whether an output can be kept from a previous run.
+
+    That is the case if the output exists and the previous run recorded the
+    same inputs (hashes and stage versions) as the ones given.
+    """
+    return previous is not None and \
+        all(previous.get(k) is not None and previous.get(k) == v
+            for k, v in inputs.items()) and \
+        output.exists()
+
+
+def get_output(level_dir, level, PG_id, pack=False, compression=None):
+    """
+    Get the output of a level for a book.
+
+    Parameters
+    ----------
+    level_dir : str
+        Path to the folder of the level.
+    level : str
+        'text', 'tokens' or 'counts'.
+    PG_id : str
+        E.g. 'PG12345'.
+    pack, compression
+        As given to process_book.
+
+    Returns
+    -------
+    FileOutput or PackOutput
+    """
+    if pack:
+        return PackOutput(get_pack(level_dir, level, compression), PG_id)
+    return FileOutput(
+        os.path.join(level_dir, "%s_%s.txt%s" % (PG_id, level, SUFFIXES[compression])),
+        compression)
+
+
+class FileOutput(object):
+    """The output of a level for a book, as a file of its own."""
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.compression = compression
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def read(self):
+        with open_compressed(self.path, compression=self.compression) as f:
+            return f.read()
+
+    def write(self, content):
+        with open_compressed(self.path, "w", self.compression) as f:
+            f.write(content)
+
+
+class PackOutput(object):
+    """The output of a level for a book, in a pack (see packs.Pack)."""
+
+    # there is no file of the book's own
+    path = None
+
+    def __init__(self, pack, PG_id):
+        self.pack = pack
+        self.PG_id = PG_id
+        self.compression = pack.compression
+
+    def exists(self):
+        return self.PG_id in self.pack
+
+    def read(self):
+        return self.pack.read_text(self.PG_id)
+
+    def write(self, content):
+        self.pack.write(self.PG_id, content)
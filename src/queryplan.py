@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy query plans over the rows of the metadata, for meta_query.
+
+A plan is a tree of nodes: terms (e.g. the books in English), combined
+with & (and), | (or) and ~ (not), e.g.
+
+    from src.queryplan import lang, subject, author
+    plan = (lang("en") | lang("fr")) & ~subject("Poetry", how="any")
+
+Nothing is computed when a plan is built. When it is evaluated, every node
+gives a boolean array with one entry per row of the metadata (a bitset),
+computed from the bitsets of its children, or from the indexes of the
+metadata for a term. The bitset of every node is kept in a PlanCache,
+keyed by the metadata file and the node, so that the same term or
+combination used again, by the same or another query (or process, if the
+cache has a folder), is not computed again. Nodes are keyed regardless of
+the order of the operands of & and |.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+HOW_LISTS = ("only", "any")
+HOW_AUTHOR = ("contains", "token")
+
+
+class Node(object):
+    """
+    A node of a query plan.
+
+    Attributes
+    ----------
+    key : tuple
+        Identifies what the node selects, e.g. ('language', 'en', 'only').
+    """
+    key = ()
+    children = ()
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __repr__(self):
+        return "%s%r" % (self.__class__.__name__, self.key)
+
+    def compute(self, masks, context):
+        """
+        Get the bitset of the node.
+
+        Parameters
+        ----------
+        masks : list of np.ndarray
+            The bitsets of the children.
+        context : object
+            What the plan is evaluated against (see evaluate).
+        """
+        raise NotImplementedError
+
+
+class Term(Node):
+    """
+    A condition on the rows, computed by context.evaluate_term(key).
+    """
+
+    def __init__(self, *key):
+        self.key = key
+
+    def compute(self, masks, context):
+        return context.evaluate_term(self.key)
+
+
+class All(Node):
+    """All rows."""
+    key = ("all",)
+
+    def compute(self, masks, context):
+        return np.ones(context.nrows, dtype=bool)
+
+
+class Rows(Node):
+    """
+    Given rows, e.g. those of the books that have been downloaded.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The bitset of the rows.
+    name : str
+        A description of the rows, for repr.
+    """
+
+    def __init__(self, mask, name="rows"):
+        self.mask = np.asarray(mask, dtype=bool)
+        digest = hashlib.sha1(np.packbits(self.mask).tobytes()).hexdigest()
+        self.key = (name, digest)
+
+    def compute(self, masks, context):
+        return self.mask.copy()
+
+
+class And(Node):
+    """The rows selected by all the operands."""
+    op = "and"
+
+    def __init__(self, *children):
+        flat = []
+        for child in children:
+            # All is neutral
+            if isinstance(child, All) and isinstance(self, And):
+                continue
+            flat.extend(child.children if type(child) is type(self)
+                        else [child])
+        # a node appears once, and the order does not matter
+        unique = OrderedDict((child.key, child) for child in flat)
+        self.children = [unique[key] for key in sorted(unique, key=repr)]
+        self.key = (self.op,) + tuple(child.key for child in self.children)
+
+    def compute(self, masks, context):
+        if not masks:
+            return np.ones(context.nrows, dtype=bool)
+        result = masks[0].copy()
+        for mask in masks[1:]:
+            result &= mask
+        return result
+
+
+class Or(And):
+    """The rows selected by any of the operands."""
+    op = "or"
+
+    def compute(self, masks, context):
+        if not masks:
+            return np.zeros(context.nrows, dtype=bool)
+        result = masks[0].copy()
+        for mask in masks[1:]:
+            result |= mask
+        return result
+
+
+class Not(Node):
+    """The rows not selected by the operand."""
+
+    def __init__(self, child):
+        self.children = [child]
+        self.key = ("not", child.key)
+
+    def compute(self, masks, context):
+        return ~masks[0]
+
+
+def sorted_rows(df, mask, column):
+    """
+    Sort the rows selected by a bitset by decreasing values of a column.
+
+    Missing values are last, and rows with the same value stay in the
+    order of df, so that sorting again does not change the order.
+
+    Returns
+    -------
+    np.ndarray
+        Positions of the rows in df.
+    """
+    rows = np.flatnonzero(mask)
+    values = df[column].iloc[rows].reset_index(drop=True)
+    return rows[values.sort_values(ascending=False, kind="stable").index.values]
+
+
+class Top(Node):
+    """
+    The n rows selected by the operand with the largest values of a
+    column (see sorted_rows).
+    """
+
+    def __init__(self, child, column, n):
+        self.children = [child]
+        self.column = column
+        self.n = n
+        self.key = ("top", child.key, column, n)
+
+    def compute(self, masks, context):
+        result = np.zeros(context.nrows, dtype=bool)
+        result[sorted_rows(context.df_all, masks[0], self.column)[:self.n]] \
+            = True
+        return result
+
+
+class PlanCache(object):
+    """
+    Bitsets of the nodes of evaluated plans.
+
+    Bitsets are kept packed (one bit per row), in memory for the most
+    recently used ones and, if a folder is given, on disk, where other
+    processes using the same folder find them.
+
+    Parameters
+    ----------
+    path : str or None
+        Path to a folder for the bitsets on disk (created if needed).
+    max_entries : int
+        Number of bitsets kept in memory.
+    """
+
+    def __init__(self, path=None, max_entries=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(repr(key).encode("UTF-8")).hexdigest()
+            + ".npy")
+
+    def get(self, key, nrows):
+        """Get the bitset of a key, or None if it is not cached."""
+        packed = self.entries.get(key)
+        if packed is None and self.path is not None:
+            try:
+                packed = np.load(self._filename(key))
+            except (OSError, ValueError):
+                packed = None
+        if packed is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, packed)
+        return np.unpackbits(packed, count=nrows).astype(bool)
+
+    def put(self, key, mask):
+        """Cache the bitset of a key."""
+        packed = np.packbits(mask)
+        self._remember(key, packed)
+        if self.path is not None:
+            # write to a temporary file first, so no one reads a partial one
+            try:
+                fd, path_tmp = tempfile.mkstemp(dir=self.path, suffix=".npy")
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, packed)
+                os.replace(path_tmp, self._filename(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, packed):
+        self.entries[key] = packed
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# the cache shared by all queries of the process, unless told otherwise
+SHARED_CACHE = PlanCache()
+
+
+def evaluate(node, context, cache=SHARED_CACHE):
+    """
+    Evaluate a plan.
+
+    Parameters
+    ----------
+    node : Node
+        The root of the plan.
+    context : object
+        What the plan is evaluated against, with attributes stamp (which
+        identifies the metadata, for the cache), nrows and df_all, and a
+        method evaluate_term(key) that gives the bitset of a Term.
+    cache : PlanCache or None
+        Where bitsets are looked up and stored.
+
+    Returns
+    -------
+    np.ndarray
+        The bitset of the rows selected by the plan.
+    """
+    key = (context.stamp, node.key)
+    if cache is not None:
+        mask = cache.get(key, context.nrows)
+        if mask is not None:
+            return mask
+    masks = [evaluate(child, context, cache) for child in node.children]
+    mask = node.compute(masks, context)
+    if cache is not None:
+        cache.put(key, mask)
+    return mask
+
+
+def _check_how(how, allowed):
+    if how not in allowed:
+        raise ValueError("how must be %s, not %r" % (
+            " or ".join(repr(h) for h in allowed), how))
+
+
+def lang(lang_sel, how="only"):
+    """Books in a language (see meta_query.filter_lang)."""
+    _check_how(how, HOW_LISTS)
+    return Term("language", lang_sel, how)
+
+
+def subject(subject_sel, how="only"):
+    """Books with a subject (see meta_query.filter_subject)."""
+    _check_how(how, HOW_LISTS)
+    return Term("subjects", subject_sel, how)
+
+
+def LCC(LCC_sel, how="any"):
+    """Books with a Library of Congress class (see meta_query.filter_LCC)."""
+    _check_how(how, HOW_LISTS)
+    return Term("LCC", LCC_sel, how)
+
+
+def author(s_sel, how="contains"):
+    """Books by an author (see meta_query.filter_author)."""
+    _check_how(how, HOW_AUTHOR)
+    return Term("author", s_sel, how)
+
+
+def year(y_sel, hmin=20):
+    """Books by an author alive in a year (see meta_query.filter_year)."""
+    if isinstance(y_sel, (list, tuple, np.ndarray)):
+        y_sel = (int(y_sel[0]), int(y_sel[1]))
+    return Term("year", y_sel, hmin)
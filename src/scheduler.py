@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Decide in which order books are sent to the worker processes.
+
+Raw files range from a few KB to tens of MB. Sending the largest books
+first keeps them from being the last ones to finish while every other
+worker sits idle, and keeping track of how much memory the books in
+flight need avoids running several huge books at the same time.
+
+All schedulers hand out files with next(block) and are told when they are
+processed with done(filename). Files can only be looked for again after
+poll_interval seconds (None if all files are known from the start).
+"""
+import os
+import time
+from collections import deque
+
+# Peak memory used by process_book, as a multiple of the raw file size.
+# The raw text, the cleaned text, the list of tokens and the Counter are
+# all in memory at the same time; measured on PG books it is about 25x.
+MEMORY_PER_BYTE = 25
+
+
+class SizeScheduler(object):
+    """
+    Hand out raw files largest first, within a memory budget.
+
+    The size of every file is read once, up front. The memory needed to
+    process a book is estimated as memory_per_byte times its size.
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        Paths to raw files.
+    memory_budget : int or None
+        Maximum memory (in bytes) the books in flight may need together.
+        None means no limit. A book larger than the budget is still
+        processed, but only when nothing else is in flight.
+    memory_per_byte : float
+        Estimated memory needed per byte of raw file.
+    """
+
+    def __init__(self, filenames, memory_budget=None,
+                 memory_per_byte=MEMORY_PER_BYTE):
+        pairs = sorted((os.path.getsize(f), f) for f in filenames)
+        # ascending by size, so that the largest file is popped first
+        self.sizes = [size for size, _ in pairs]
+        self.filenames = [f for _, f in pairs]
+        self.memory_budget = memory_budget
+        self.memory_per_byte = memory_per_byte
+        self.in_flight = {}
+        self.poll_interval = None
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def memory(self, size):
+        """Estimated memory needed to process a file of the given size."""
+        return int(size * self.memory_per_byte)
+
+    def memory_in_flight(self):
+        """Estimated memory needed by the books in flight."""
+        return sum(self.in_flight.values())
+
+    def next(self, block=False):
+        """
+        Get the next file to process.
+
+        Files are handed out strictly from largest to smallest. If the
+        largest pending file does not fit in what is left of the memory
+        budget, nothing is handed out until some book is done; filling the
+        gap with smaller books could leave the large one for the very end.
+
+        Returns
+        -------
+        str or None
+            The largest pending file, or None if there is none or if it
+            has to wait for memory to be freed.
+        """
+        if not self.filenames:
+            return None
+        memory = self.memory(self.sizes[-1])
+        if self.memory_budget is not None and self.in_flight and \
+                self.memory_in_flight() + memory > self.memory_budget:
+            return None
+        self.sizes.pop()
+        filename = self.filenames.pop()
+        self.in_flight[filename] = memory
+        return filename
+
+    def done(self, filename):
+        """Mark a file handed out by next as processed."""
+        del self.in_flight[filename]
+
+
+class StreamScheduler(object):
+    """
+    Hand out raw files in the order they come, without looking ahead.
+
+    Has the same interface as SizeScheduler, so that filenames can be
+    streamed from a generator such as glob.iglob.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = iter(filenames)
+        self.poll_interval = None
+
+    def next(self, block=False):
+        """Get the next file to process, or None if there are no more."""
+        return next(self.filenames, None)
+
+    def done(self, filename):
+        """Mark a file handed out by next as processed."""
+        pass
+
+
+class WatchScheduler(object):
+    """
+    Hand out raw files as they appear, e.g. while they are being downloaded.
+
+    Has the same interface as SizeScheduler. Files are looked for by
+    calling poll, at most every poll_interval seconds, and handed out in
+    the order they are found.
+
+    Parameters
+    ----------
+    poll : function
+        Called without arguments, returns the files that are ready to be
+        processed since the last call (see watch.RawWatcher), or None
+        once there will not be any more.
+    poll_interval : float
+        Seconds between two calls of poll.
+    """
+
+    def __init__(self, poll, poll_interval=10.):
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.filenames = deque()
+        self.last_poll = None
+        self.stopped = False
+
+    def next(self, block=False):
+        """
+        Get the next file to process.
+
+        Parameters
+        ----------
+        block : bool
+            If no file is ready, wait until one is (e.g. when no book is
+            being processed), instead of returning None.
+
+        Returns
+        -------
+        str or None
+            The next file, or None if none is ready (and block is False)
+            or there will not be any more.
+        """
+        while not self.filenames and not self.stopped:
+            wait = 0.
+            if self.last_poll is not None:
+                wait = self.last_poll + self.poll_interval - time.time()
+            if wait > 0:
+                if not block:
+                    return None
+                time.sleep(wait)
+            self.last_poll = time.time()
+            filenames = self.poll()
+            if filenames is None:
+                self.stopped = True
+            else:
+                self.filenames.extend(filenames)
+        if not self.filenames:
+            return None
+        return self.filenames.popleft()
+
+    def done(self, filename):
+        """Mark a file handed out by next as processed."""
+        pass
@@ -4,41 +4,84 @@
    You will get a list of tokens
 """
 
+import itertools
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import nltk
 nltk.data.path=["src/nltk_data"]
 
 from nltk.tokenize.treebank import TreebankWordTokenizer
-from nltk.tokenize import sent_tokenize
+
+from .utils import get_langs_dict
+
+
+class TokenizerContext(object):
+    '''The models used to tokenize texts, loaded once and then reused.
+    Holds the punkt sentence tokenizer of every language loaded so far
+    and a single Treebank tokenizer. Each process uses one context (see
+    get_context), so that no book pays for loading a model.
+    '''
+
+    def __init__(self):
+        self.punkt = {}
+        self.word_tokenizer = TreebankWordTokenizer()
+
+    def preload(self, languages=None):
+        '''Load the punkt models of the given languages.
+        By default, those of all the languages in get_langs_dict.
+        '''
+        if languages is None:
+            languages = get_langs_dict().values()
+        for language in languages:
+            self.get_punkt(language)
+
+    def get_punkt(self, language="english"):
+        '''Get the punkt sentence tokenizer of a language.'''
+        if language not in self.punkt:
+            self.punkt[language] = nltk.data.load(
+                "tokenizers/punkt/PY3/%s.pickle" % language)
+        return self.punkt[language]
+
+    def tokenize(self, text, language="english"):
+        '''Tokenize a string into a list of tokens (see tokenize_text).'''
+        ## list of tokens
+        list_tokens = []
+        ## loop over all sentences
+        for sent in self.get_punkt(language).tokenize(text):
+            ## tokenize the sentence and add tokens to list of tokens
+            list_tokens += self.word_tokenizer.tokenize(sent)
+        list_tokens = filter_tokens(list_tokens)
+        return list_tokens
+
+
+## the context of the current process, created when first needed
+_context = None
+
+
+def get_context():
+    '''Get the tokenizer context of the current process.'''
+    global _context
+    if _context is None:
+        _context = TokenizerContext()
+    return _context
 
 
 def tokenize_text(text, language="english"):
     '''Tokenize a string into a list of tokens.
     Use NLTK's Treebankwordtokenizer.
-    Note that we first split into sentences using NLTK's sent_tokenize.
+    Note that we first split into sentences using NLTK's punkt model
+    (as sent_tokenize does).
     We additionally call a filtering function to remove un-wanted tokens.
+    The models are those of the context of the current process.
     
     IN:
     - text, str
     OUT:
     - list of strings
     '''
-    ## list of tokens
-    list_tokens = []
-    
-    ## split text into sentences
-    sentences=sent_tokenize(text, language=language)
-    
-    ## define the tokenizer
-    tokenizer = TreebankWordTokenizer()
-    ## loop over all sentences
-    for sent in sentences:
-        ## tokenize the sentence
-        sent_tokenized = tokenizer.tokenize(sent)
-        ## lowercase the tokens
-        ## add tokens to list of tokens
-        list_tokens += sent_tokenized
-    list_tokens = filter_tokens(list_tokens)
-    return list_tokens
+    return get_context().tokenize(text, language=language)
 
 def filter_tokens(list_tokens):
     '''Remove un-wanted tokens from list of tokens
@@ -46,4 +89,151 @@ def filter_tokens(list_tokens):
     We lowercase every token with string.lower()
     '''
     list_tokens_filter = [h.lower() for h in list_tokens if h.isalpha()]
-    return list_tokens_filter
\ No newline at end of file
+    return list_tokens_filter
+
+
+# bump whenever a change to tokenize_text (or filter_tokens) changes its output
+tokenize_text.version = 1
+
+
+def tokenize_texts(texts, language="english", workers=1, batch_size=1000):
+    '''Tokenize many strings, yielding a list of tokens for each.
+    The output for every text is the same as that of tokenize_text, and
+    comes in the same order as the texts. The texts are taken in batches;
+    within a batch, texts of the same language are tokenized together,
+    with the models of the context of the process. With workers > 1 the
+    batches are tokenized in a pool of processes, each of which loads
+    the models of all languages once; only a few batches are in flight
+    at any time, so texts can come from a generator.
+
+    IN:
+    - texts, iterable of str
+    - language, str (the same for all texts) or iterable of str (one
+      for each text)
+    - workers, int
+    - batch_size, int
+    OUT:
+    - generator of lists of strings
+    '''
+    if isinstance(language, str):
+        languages = itertools.repeat(language)
+    else:
+        languages = language
+    pairs = zip(texts, languages)
+    batches = iter(lambda: list(itertools.islice(pairs, batch_size)), [])
+
+    if workers <= 1:
+        for batch in batches:
+            yield from _tokenize_batch(batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_tokenize_worker) as executor:
+        ## keep the results in order, with a bounded number of batches
+        ## in flight
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_tokenize_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _init_tokenize_worker():
+    '''Load the models of all languages in a worker of tokenize_texts.'''
+    get_context().preload()
+
+
+def _tokenize_batch(batch):
+    '''Tokenize a list of (text, language) pairs, grouped by language.
+    Returns the lists of tokens in the order of the pairs.
+    '''
+    context = get_context()
+    by_language = {}
+    for i, (_, language) in enumerate(batch):
+        by_language.setdefault(language, []).append(i)
+    list_tokens = [None] * len(batch)
+    for language, indices in by_language.items():
+        ## the same calls as in TokenizerContext.tokenize, but looking up
+        ## the models once per language
+        sent_tokenize = context.get_punkt(language).tokenize
+        word_tokenize = context.word_tokenizer.tokenize
+        for i in indices:
+            tokens = []
+            for sent in sent_tokenize(batch[i][0]):
+                tokens += word_tokenize(sent)
+            list_tokens[i] = filter_tokens(tokens)
+    return list_tokens
+
+
+## characters around which the Treebank tokenizer always splits
+_PUNCTUATION = r"""\"\;@#$%&?!()\[\]{}<>"""
+## what may follow a token: any of the above, whitespace, commas and colons
+## not followed by a digit, double dashes and ellipses
+_TOKEN_END = r"(?=[\s%s]|[,:](?!\d)|--|\.\.\.|$)" % _PUNCTUATION
+## the same, but Treebank only splits off contractions and closing quotes
+## followed by a space, not by other whitespace
+_TOKEN_END_SPACE = r"(?=[ %s]|[,:](?!\d)|--|\.\.\.|$)" % _PUNCTUATION
+_CONTRACTIONS = r"(?i:n't|'ll|'re|'ve|'s|'m|'d)"
+## a run of letters that the Treebank tokenizer keeps as a token of its own,
+## possibly preceded by the 't of 'tis and 'twas, and followed by a
+## contraction or a closing quote it splits off, or by a period
+_FAST_TOKEN_RE = re.compile(
+    r"(?:(?<=[\s%s,:])|(?<=--)|^)" % _PUNCTUATION +
+    r"(?:'[tT](?=(?i:is|was)\b))?" +
+    r"([^\W\d_]+)" +
+    r"(?:" +
+    _CONTRACTIONS + _TOKEN_END_SPACE + "|" +
+    _CONTRACTIONS + r"?(\.)'?" + _TOKEN_END + "|" +
+    r"'" + _TOKEN_END_SPACE + "|" +
+    _TOKEN_END + ")")
+## words split by the Treebank tokenizer (MacIntyre's contractions)
+_FAST_SPLIT_WORDS = {
+    "cannot": ("can", "not"),
+    "gimme": ("gim", "me"),
+    "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"),
+    "lemme": ("lem", "me"),
+    "wanna": ("wan", "na"),
+}
+
+
+def get_abbrev_types(language="english"):
+    '''Get the abbreviations known to the punkt model of a language.
+    A word followed by one of these and a period does not end a sentence.
+    '''
+    return get_context().get_punkt(language)._params.abbrev_types
+
+
+def tokenize_text_fast(text, language="english"):
+    '''Tokenize a string into a list of lowercase alphabetic tokens.
+    This is a faster approximation of tokenize_text: it finds the tokens
+    with a single regex instead of splitting into sentences with punkt,
+    tokenizing each with the Treebank tokenizer and filtering the tokens.
+    A period after a word is taken to end a sentence (and is split off,
+    so that the word is kept) unless the word is an abbreviation of the
+    punkt model; that is where most of the differences come from.
+    See benchmarks/diff_tokenizers.py for a comparison.
+
+    IN:
+    - text, str
+    OUT:
+    - list of strings
+    '''
+    abbrev_types = get_abbrev_types(language)
+    list_tokens = []
+    for word, period in _FAST_TOKEN_RE.findall(text):
+        if not word.isalpha():
+            continue
+        word = word.lower()
+        ## a word with a period is only kept at the end of a sentence
+        if period and word in abbrev_types:
+            continue
+        if word in _FAST_SPLIT_WORDS:
+            list_tokens += _FAST_SPLIT_WORDS[word]
+        else:
+            list_tokens.append(word)
+    return list_tokens
+
+tokenize_text_fast.version = 1
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+A corpus-wide vocabulary, to store the tokens of books as integer ids.
+
+The vocabulary is a text file with one term per line; the id of a term is
+the number of its line, starting at 0. Terms are only ever appended, in the
+order they are first seen, so an id never changes once it is given and the
+ids files of books processed earlier stay valid as the corpus grows.
+
+The ids level holds one .npy file per book with the id of each of its
+tokens (as uint32), which can be memory-mapped with np.load(path,
+mmap_mode='r'). The counts of a book are np.bincount of its ids.
+"""
+import io
+import os
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+
+class Vocabulary(object):
+    """
+    Map terms to integer ids, adding the terms not seen before.
+
+    Parameters
+    ----------
+    path : str or None
+        Path to the vocabulary file. The terms in it are loaded, and new
+        terms are appended to it as soon as they get an id, so that it
+        always covers the ids files written so far. None keeps the
+        vocabulary in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.terms = []
+        if path is not None and os.path.isfile(path):
+            with io.open(path, encoding="UTF-8") as f:
+                self.terms = f.read().splitlines()
+        self.index = {term: i for i, term in enumerate(self.terms)}
+        self._file = None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def ids(self, terms):
+        """
+        Get the ids of some terms, adding the ones not in the vocabulary.
+
+        Parameters
+        ----------
+        terms : list of str
+
+        Returns
+        -------
+        np.ndarray of uint32
+            The id of every term, in the same order.
+        """
+        index = self.index
+        new_terms = []
+        ids = []
+        for term in terms:
+            i = index.get(term)
+            if i is None:
+                i = index[term] = len(self.terms)
+                self.terms.append(term)
+                new_terms.append(term)
+            ids.append(i)
+        if new_terms and self.path is not None:
+            if self._file is None:
+                self._file = io.open(self.path, "a", encoding="UTF-8")
+            self._file.write("".join(term + "\n" for term in new_terms))
+            self._file.flush()
+        return np.array(ids, dtype=np.uint32)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class VocabularyManager(BaseManager):
+    """
+    Serve a single Vocabulary to many worker processes.
+
+    The vocabulary lives in the manager's process, and every worker gets a
+    proxy to it, so that ids are given out in one place. A worker makes a
+    single call per book, with the distinct terms of the book.
+    """
+    pass
+
+
+VocabularyManager.register(
+    "Vocabulary", Vocabulary, exposed=("ids", "close", "__len__"))
+
+
+def encode_tokens(tokens):
+    """
+    Give the distinct tokens of a book ids of their own.
+
+    Parameters
+    ----------
+    tokens : list of str
+
+    Returns
+    -------
+    (list of str, np.ndarray of uint32)
+        The distinct tokens, in the order they first appear, and the
+        position of every token in that list.
+    """
+    index = {}
+    local_ids = np.fromiter(
+        (index.setdefault(w, len(index)) for w in tokens),
+        dtype=np.uint32, count=len(tokens))
+    return list(index), local_ids
+
+
+def count_ids(types, local_ids):
+    """
+    Count the tokens of a book from their ids (see encode_tokens).
+
+    Returns
+    -------
+    list of (str, int)
+        The types with their counts, from most to least common; types
+        with the same count are in the order they first appear, as in
+        collections.Counter.most_common.
+    """
+    counts = np.bincount(local_ids, minlength=len(types))
+    order = np.argsort(-counts, kind="stable")
+    return [(types[i], int(counts[i])) for i in order]
+
+
+def load_ids(path, mmap=True):
+    """
+    Load the token ids of a book.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .npy file.
+    mmap : bool
+        Memory-map the file instead of reading it.
+
+    Returns
+    -------
+    np.ndarray of uint32
+    """
+    return np.load(path, mmap_mode="r" if mmap else None)
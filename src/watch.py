@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Watch the raw folder for books to process, e.g. while get_data.py runs.
+
+RawWatcher.poll lists the raw folder and returns the raw files that are new
+or changed since the last time they were returned. A file is only returned
+once it has not been modified for a few seconds, so that a file still being
+written is not processed before it is complete (files hard-linked from the
+mirror are complete as soon as they appear). If the mirror is given, the
+books rsync has finished downloading to it are first linked into the raw
+folder (see mirror.populate_raw), so that processing starts while the rest
+of the mirror is still being downloaded.
+
+A file that could not be processed (see RawWatcher.failed) is returned
+again once it changes, or once the metadata file changes: get_data.py only
+writes the metadata of new books after the download, so books found before
+then fail with no metadata until it is written.
+"""
+import fnmatch
+import os
+import time
+from os.path import join
+
+from .mirror import populate_raw, scan_mirror
+
+
+class RawWatcher(object):
+    """
+    Find the raw files that are ready to be processed.
+
+    Parameters
+    ----------
+    raw_dir : str
+        Path to the raw folder.
+    pattern : str
+        Only books matching PG<pattern>_raw.txt are watched.
+    settle : float
+        Seconds a file must not have been modified for to be returned.
+    mirror_dir : str or None
+        If given, books in the mirror are linked into raw_dir at every
+        poll.
+    idle_timeout : float or None
+        Stop (poll returns None) once no file has been returned for this
+        many seconds. None to watch until interrupted.
+    metadata_path : str or None
+        Path to the metadata file. Files that failed are returned again
+        when it changes.
+
+    Attributes
+    ----------
+    returned : dict
+        Name of every file returned to (size, mtime) when it was.
+    failures : dict
+        Name of every file that failed to the (size, mtime) of the
+        metadata file when it did.
+    """
+
+    def __init__(self, raw_dir, pattern="*", settle=5., mirror_dir=None,
+                 idle_timeout=None, metadata_path=None):
+        self.raw_dir = raw_dir
+        self.pattern = "PG%s_raw.txt" % pattern
+        self.settle = settle
+        self.mirror_dir = mirror_dir
+        self.idle_timeout = idle_timeout
+        self.metadata_path = metadata_path
+        self.returned = {}
+        self.failures = {}
+        self.last_found = time.time()
+
+    def _metadata_stamp(self):
+        if self.metadata_path is None:
+            return None
+        try:
+            stat = os.stat(self.metadata_path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def failed(self, filename):
+        """
+        Tell that a file returned could not be processed.
+
+        It is returned again once it changes, or once the metadata file
+        does.
+        """
+        self.failures[os.path.basename(filename)] = self._metadata_stamp()
+
+    def poll(self):
+        """
+        Get the raw files that became ready since the last call.
+
+        Returns
+        -------
+        list of str or None
+            Paths to the files, or None if the watch is over (see
+            idle_timeout).
+        """
+        if self.mirror_dir is not None:
+            index, _ = scan_mirror(self.mirror_dir)
+            populate_raw(self.mirror_dir, self.raw_dir, index)
+
+        # the files that failed before the metadata changed are tried again
+        stamp = self._metadata_stamp()
+        for name, failed_stamp in list(self.failures.items()):
+            if failed_stamp != stamp:
+                self.returned.pop(name, None)
+                del self.failures[name]
+
+        now = time.time()
+        ready = []
+        with os.scandir(self.raw_dir) as entries:
+            for entry in entries:
+                if not fnmatch.fnmatchcase(entry.name, self.pattern):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self.returned.get(entry.name) == signature or \
+                        now - stat.st_mtime < self.settle:
+                    continue
+                self.returned[entry.name] = signature
+                self.failures.pop(entry.name, None)
+                ready.append(join(self.raw_dir, entry.name))
+
+        if ready:
+            self.last_found = now
+        elif self.idle_timeout is not None and \
+                now - self.last_found > self.idle_timeout:
+            return None
+        return sorted(ready)